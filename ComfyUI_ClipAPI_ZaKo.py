@@ -1,9 +1,21 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
 import threading
 import logging
-from typing import Dict, Optional, Tuple, Any
+from collections import OrderedDict, deque
+from contextlib import closing, contextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Any
 
 import requests
 from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
 from urllib3.util.retry import Retry
 
 # 日志配置
@@ -14,6 +26,994 @@ logging.basicConfig(
 logger = logging.getLogger("ZaKoPromptMerger")
 
 
+def _get_data_dir() -> str:
+    """插件数据目录：优先ComfyUI的user目录，脱离ComfyUI运行时退回插件目录"""
+    try:
+        import folder_paths  # ComfyUI内置模块
+        base_dir = folder_paths.get_user_directory()
+    except Exception:
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+    data_dir = os.path.join(base_dir, "ZaKoPromptMerger")
+    os.makedirs(data_dir, exist_ok=True)
+    return data_dir
+
+
+class ZaKoMetrics:
+    """进程级调用指标：耗时直方图、重试次数、状态码/错误类型、Token数；提供Prometheus文本和JSON快照"""
+
+    LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+    FLUSH_INTERVAL = 60.0
+
+    _counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+    _histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List[float]] = {}
+    _lock = threading.Lock()
+    _last_flush = time.monotonic()
+
+    @classmethod
+    def _inc(cls, name: str, labels: Dict[str, str], value: float = 1.0) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        cls._counters[key] = cls._counters.get(key, 0.0) + value
+
+    @classmethod
+    def _observe(cls, name: str, labels: Dict[str, str], value: float) -> None:
+        # 列表结构：各桶计数 + 总和 + 总数
+        key = (name, tuple(sorted(labels.items())))
+        hist = cls._histograms.get(key)
+        if hist is None:
+            hist = cls._histograms[key] = [0.0] * (len(cls.LATENCY_BUCKETS) + 2)
+        for i, bound in enumerate(cls.LATENCY_BUCKETS):
+            if value <= bound:
+                hist[i] += 1
+        hist[-2] += value
+        hist[-1] += 1
+
+    @classmethod
+    def record_call(cls, trace: Dict[str, Any]) -> None:
+        """记录一次HTTP请求；trace由_call_api填写"""
+        model = trace.get("model", "")
+        endpoint = trace.get("endpoint", "")
+        base = {"model": model, "endpoint": endpoint}
+        with cls._lock:
+            cls._inc("zako_requests_total", dict(
+                base, status=str(trace.get("status", 0)), error=trace.get("error", "")
+            ))
+            cls._inc("zako_retries_total", base, trace.get("retries", 0))
+            for phase in ("ttfb", "first_token", "total"):
+                if trace.get(phase) is not None:
+                    cls._observe("zako_request_duration_seconds", dict(base, phase=phase), trace[phase])
+            usage = trace.get("usage") or {}
+            for token_type in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+                if usage.get(token_type):
+                    cls._inc("zako_tokens_total", dict(base, type=token_type), usage[token_type])
+            need_flush = time.monotonic() - cls._last_flush >= cls.FLUSH_INTERVAL
+            if need_flush:
+                cls._last_flush = time.monotonic()
+        if need_flush:
+            cls.flush_json()
+
+    @staticmethod
+    def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+        if not labels:
+            return ""
+        parts = []
+        for name, value in labels:
+            value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            parts.append(f'{name}="{value}"')
+        return "{" + ",".join(parts) + "}"
+
+    @classmethod
+    def prometheus_text(cls) -> str:
+        lines = []
+        with cls._lock:
+            counters = sorted(cls._counters.items())
+            histograms = sorted((key, list(hist)) for key, hist in cls._histograms.items())
+        for name in sorted({key[0] for key, _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(
+                f"{name}{cls._format_labels(labels)} {value:g}"
+                for (metric, labels), value in counters if metric == name
+            )
+        for name in sorted({key[0] for key, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), hist in histograms:
+                if metric != name:
+                    continue
+                for bound, count in zip(cls.LATENCY_BUCKETS, hist):
+                    lines.append(f"{name}_bucket{cls._format_labels(labels + (('le', f'{bound:g}'),))} {count:g}")
+                lines.append(f"{name}_bucket{cls._format_labels(labels + (('le', '+Inf'),))} {hist[-1]:g}")
+                lines.append(f"{name}_sum{cls._format_labels(labels)} {hist[-2]:.6f}")
+                lines.append(f"{name}_count{cls._format_labels(labels)} {hist[-1]:g}")
+        return "\n".join(lines) + "\n"
+
+    @classmethod
+    def snapshot(cls) -> Dict[str, Any]:
+        with cls._lock:
+            return {
+                "time": time.time(),
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(cls._counters.items())
+                ],
+                "histograms": [
+                    {
+                        "name": name, "labels": dict(labels),
+                        "buckets": dict(zip([f"{b:g}" for b in cls.LATENCY_BUCKETS], hist[:-2])),
+                        "sum": hist[-2], "count": hist[-1],
+                    }
+                    for (name, labels), hist in sorted(cls._histograms.items())
+                ],
+            }
+
+    @classmethod
+    def flush_json(cls) -> None:
+        """写入 metrics.json，先写临时文件再替换，避免读到半个文件"""
+        try:
+            path = os.path.join(_get_data_dir(), "metrics.json")
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(cls.snapshot(), f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"写入指标文件失败：{e}")
+
+
+class ZaKoResponseCache:
+    """两级结果缓存：进程内LRU + SQLite磁盘层（按有效期和条目数淘汰）"""
+
+    def __init__(self, memory_size: int, disk_path: Optional[str], disk_max_entries: int):
+        self.memory_size = memory_size
+        self.disk_path = disk_path
+        self.disk_max_entries = disk_max_entries
+        self.hits = 0
+        self.misses = 0
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_writes = 0
+        if self.disk_path:
+            try:
+                with self._connect() as conn:
+                    conn.execute(
+                        "CREATE TABLE IF NOT EXISTS cache ("
+                        "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                        "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+                    )
+            except sqlite3.Error as e:
+                logger.warning(f"磁盘缓存不可用，仅使用内存缓存：{e}")
+                self.disk_path = None
+
+    @staticmethod
+    def make_key(**parts: Any) -> str:
+        raw = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # sqlite3连接自身的with只负责提交/回滚，不会关闭连接，这里用closing确保每次用完即关闭
+        with closing(sqlite3.connect(self.disk_path, timeout=5)) as conn, conn:
+            yield conn
+
+    def _remember(self, key: str, value: str, expires_at: float) -> None:
+        self._memory[key] = (value, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Tuple[Optional[str], str]:
+        """返回 (结果, 命中层级)，层级为 memory / disk / 空字符串"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return entry[0], "memory"
+                del self._memory[key]
+
+        if self.disk_path:
+            try:
+                with self._connect() as conn:
+                    row = conn.execute(
+                        "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row is not None and row[1] > now:
+                        conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+                        with self._lock:
+                            self._remember(key, row[0], row[1])
+                            self.hits += 1
+                        return row[0], "disk"
+            except sqlite3.Error as e:
+                logger.warning(f"读取磁盘缓存失败：{e}")
+
+        with self._lock:
+            self.misses += 1
+        return None, ""
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        now = time.time()
+        expires_at = now + ttl
+        with self._lock:
+            self._remember(key, value, expires_at)
+            self._disk_writes += 1
+            need_prune = self._disk_writes % 50 == 0
+
+        if not self.disk_path:
+            return
+        try:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, value, expires_at, now)
+                )
+                if need_prune:
+                    self._prune(conn, now)
+        except sqlite3.Error as e:
+            logger.warning(f"写入磁盘缓存失败：{e}")
+
+    def _prune(self, conn: sqlite3.Connection, now: float) -> None:
+        # 先删过期条目，再按最近访问时间淘汰超出上限的部分
+        conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+        conn.execute(
+            "DELETE FROM cache WHERE key IN ("
+            "SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.disk_max_entries,)
+        )
+
+    def stats_text(self) -> str:
+        with self._lock:
+            return f"缓存命中{self.hits}/未命中{self.misses}"
+
+
+class ZaKoRateLimiter:
+    """进程级自适应限流：令牌桶控制请求速率，AIMD调整并发上限，遵守Retry-After与限流响应头
+
+    收到第一次限流信号（429或剩余额度为0）之前不限速、不限并发；之后以当时实际的发送速率和
+    进行中请求数为起点，429时减半，成功时缓慢恢复。
+    """
+
+    FALLBACK_RATE = 5.0
+    MIN_RATE = 0.2
+    MAX_RATE = 50.0
+    RATE_INCREASE_STEP = 0.1
+    MAX_CONCURRENCY = 16.0
+    DEFAULT_THROTTLE_PAUSE = 1.0
+    RATE_WINDOW = 20
+
+    # 同一密钥+模型共用一个限流器，跨线程、跨节点协调
+    _registry: Dict[str, "ZaKoRateLimiter"] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, name: str):
+        self.name = name
+        # None表示尚未收到限流信号，不做限制
+        self.rate: Optional[float] = None
+        self.concurrency_limit: Optional[float] = None
+        self.in_flight = 0
+        self.throttle_count = 0
+        self._max_concurrency = self.MAX_CONCURRENCY
+        self._recent_sends: deque = deque(maxlen=self.RATE_WINDOW)
+        self._tokens = 1.0
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._cond = threading.Condition()
+
+    @classmethod
+    def for_key(cls, api_key: str, model_name: str, endpoint: str = "") -> "ZaKoRateLimiter":
+        # 日志和字典键中只保留密钥哈希前缀，不落明文；不同接口地址的额度互不影响
+        key = f"{hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:8]}:{model_name}"
+        if endpoint:
+            key = f"{key}@{endpoint}"
+        with cls._registry_lock:
+            limiter = cls._registry.get(key)
+            if limiter is None:
+                limiter = cls._registry[key] = cls(key)
+            return limiter
+
+    @staticmethod
+    def _parse_duration(value: Optional[str]) -> Optional[float]:
+        """解析 Retry-After（秒数或HTTP日期）及 1s / 6m0s / 20ms 形式的重置时间"""
+        if not value:
+            return None
+        value = value.strip()
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+        if parts:
+            scale = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+            return sum(float(num) * scale[unit] for num, unit in parts)
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def _start_throttling(self, now: float) -> None:
+        """第一次收到限流信号时，以实际发送速率和进行中请求数作为初始速率和并发上限"""
+        if self.rate is not None:
+            return
+        sends = self._recent_sends
+        elapsed = now - sends[0] if len(sends) >= 2 else 0.0
+        observed_rate = (len(sends) - 1) / elapsed if elapsed > 0 else self.FALLBACK_RATE
+        self.rate = min(self.MAX_RATE, max(self.MIN_RATE, observed_rate))
+        self.concurrency_limit = float(max(1, self.in_flight))
+        self._max_concurrency = max(self.MAX_CONCURRENCY, self.concurrency_limit)
+        self._tokens = 0.0
+        self._updated_at = now
+
+    def _refill(self, now: float) -> None:
+        if self.rate is None:
+            return
+        burst = max(1.0, self.rate)
+        self._tokens = min(burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def acquire(self) -> float:
+        """阻塞直到拿到令牌和并发名额，返回等待秒数"""
+        start = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._blocked_until:
+                    wait = self._blocked_until - now
+                elif self.concurrency_limit is not None and self.in_flight >= int(self.concurrency_limit):
+                    wait = None
+                elif self.rate is not None and self._tokens < 1.0:
+                    wait = (1.0 - self._tokens) / self.rate
+                else:
+                    if self.rate is not None:
+                        self._tokens -= 1.0
+                    self.in_flight += 1
+                    self._recent_sends.append(now)
+                    return time.monotonic() - start
+                self._cond.wait(timeout=wait)
+
+    def release(self) -> None:
+        with self._cond:
+            self.in_flight = max(0, self.in_flight - 1)
+            self._cond.notify_all()
+
+    def observe(self, status_code: int, headers: Any) -> None:
+        """根据响应调整速率：429乘性减半并暂停，成功则加性恢复"""
+        retry_after = self._parse_duration(headers.get("Retry-After"))
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        reset_after = self._parse_duration(headers.get("x-ratelimit-reset-requests"))
+        with self._cond:
+            now = time.monotonic()
+            if status_code == 429:
+                self.throttle_count += 1
+                # 暂停期间陆续返回的429来自同一波请求，只减半一次
+                if now >= self._blocked_until:
+                    self._start_throttling(now)
+                    self.rate = max(self.MIN_RATE, self.rate * 0.5)
+                    self.concurrency_limit = max(1.0, self.concurrency_limit * 0.5)
+                pause = retry_after if retry_after is not None else self.DEFAULT_THROTTLE_PAUSE
+                self._blocked_until = max(self._blocked_until, now + pause)
+                self._tokens = 0.0
+                logger.warning(
+                    f"限流[{self.name}]：第{self.throttle_count}次被限流(HTTP 429)，暂停{pause:.1f}秒，"
+                    f"{self.stats_text()}"
+                )
+            elif status_code < 400:
+                if self.rate is not None:
+                    self.rate = min(self.MAX_RATE, self.rate + self.RATE_INCREASE_STEP)
+                    self.concurrency_limit = min(
+                        self._max_concurrency, self.concurrency_limit + 1.0 / self.concurrency_limit
+                    )
+                if remaining is not None and str(remaining).strip() == "0" and reset_after:
+                    self._start_throttling(now)
+                    self._blocked_until = max(self._blocked_until, now + reset_after)
+                    logger.info(f"限流[{self.name}]：服务端剩余额度为0，{reset_after:.1f}秒后再发送，{self.stats_text()}")
+            self._cond.notify_all()
+
+    def stats_text(self) -> str:
+        rate_text = "不限" if self.rate is None else f"{self.rate:.2f}次/秒"
+        concurrency_text = "不限" if self.concurrency_limit is None else str(int(self.concurrency_limit))
+        return (
+            f"当前速率{rate_text}，并发上限{concurrency_text}，"
+            f"进行中{self.in_flight}，累计限流{self.throttle_count}次"
+        )
+
+
+class ZaKoEndpoint(NamedTuple):
+    url: str
+    model: str
+    api_key: str
+
+    @property
+    def label(self) -> str:
+        return f"{self.model}@{urlparse(self.url).netloc or self.url}"
+
+
+class ZaKoEndpointRouter:
+    """多接口路由：按各接口近期耗时的EWMA排序，记录耗时样本用于计算对冲阈值（p95）"""
+
+    EWMA_ALPHA = 0.3
+    LATENCY_SAMPLES = 100
+    HEDGE_MIN_SAMPLES = 5
+    FAILURE_PENALTY = 2.0
+
+    _stats: Dict[ZaKoEndpoint, Dict[str, Any]] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def _entry(cls, endpoint: ZaKoEndpoint) -> Dict[str, Any]:
+        entry = cls._stats.get(endpoint)
+        if entry is None:
+            entry = cls._stats[endpoint] = {"ewma": None, "samples": deque(maxlen=cls.LATENCY_SAMPLES)}
+        return entry
+
+    @classmethod
+    def rank(cls, endpoints: List[ZaKoEndpoint]) -> List[ZaKoEndpoint]:
+        # 没有历史数据的接口排在前面，保证每个接口都能被探测到；同分时保持配置顺序
+        with cls._lock:
+            scores = {endpoint: cls._entry(endpoint)["ewma"] for endpoint in endpoints}
+        return sorted(endpoints, key=lambda endpoint: scores[endpoint] or 0.0)
+
+    @classmethod
+    def record(cls, endpoint: ZaKoEndpoint, elapsed: float, success: bool) -> None:
+        with cls._lock:
+            entry = cls._entry(endpoint)
+            if success:
+                entry["samples"].append(elapsed)
+            else:
+                # 失败按惩罚后的耗时计入，使路由暂时避开该接口
+                elapsed = max(elapsed, entry["ewma"] or 0.0) * cls.FAILURE_PENALTY
+            if entry["ewma"] is None:
+                entry["ewma"] = elapsed
+            else:
+                entry["ewma"] = cls.EWMA_ALPHA * elapsed + (1 - cls.EWMA_ALPHA) * entry["ewma"]
+
+    @classmethod
+    def hedge_delay(cls, endpoint: ZaKoEndpoint) -> Optional[float]:
+        """成功样本足够时返回p95耗时，否则不对冲"""
+        with cls._lock:
+            samples = sorted(cls._entry(endpoint)["samples"])
+        if len(samples) < cls.HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+
+class ZaKoTimeoutAdvisor:
+    """自适应读取超时：按接口+模型记录单次请求的等待耗时，取近期p99乘以系数作为读取超时
+
+    读取超时作用于两次收到数据的间隔：流式请求取首Token耗时；非流式要等整个输出生成完，
+    耗时按输出Token数归一化为每Token耗时，使用时再乘以本次的最大输出Token。
+    """
+
+    LATENCY_SAMPLES = 200
+    MIN_SAMPLES = 10
+    P99_FACTOR = 2.0
+    MIN_READ_TIMEOUT = 5
+
+    # (接口, 模型, 是否流式) -> 近期样本
+    _samples: Dict[Tuple[str, str, bool], deque] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def _append(cls, key: Tuple[str, str, bool], sample: float) -> None:
+        with cls._lock:
+            samples = cls._samples.get(key)
+            if samples is None:
+                samples = cls._samples[key] = deque(maxlen=cls.LATENCY_SAMPLES)
+            samples.append(sample)
+
+    @classmethod
+    def record(cls, trace: Dict[str, Any], stream: bool) -> None:
+        """记录一次成功请求"""
+        if trace.get("error") or trace.get("retries"):
+            # 经过urllib3重试的请求包含退避等待，不代表单次耗时
+            return
+        if stream:
+            sample = trace.get("first_token")
+        else:
+            completion_tokens = (trace.get("usage") or {}).get("completion_tokens")
+            sample = trace["total"] / completion_tokens if completion_tokens and trace.get("total") else None
+        if sample:
+            cls._append((trace.get("endpoint", ""), trace.get("model", ""), stream), sample)
+
+    @classmethod
+    def record_timeout(cls, endpoint: str, model: str, stream: bool, read_timeout: int, max_tokens: int) -> None:
+        """自适应超时触发时把超时值记为样本（实际耗时至少这么长），否则只记成功请求，p99永远不会升高"""
+        cls._append((endpoint, model, stream), read_timeout if stream else read_timeout / max(max_tokens, 1))
+
+    @classmethod
+    def read_timeout(
+        cls, endpoint: str, model: str, stream: bool, max_tokens: int, upper_bound: int
+    ) -> Tuple[int, Optional[float]]:
+        """返回(读取超时, 按p99估算的等待秒数)；样本不足时使用设置值，结果不超过设置值"""
+        with cls._lock:
+            samples = sorted(cls._samples.get((endpoint, model, stream), ()))
+        if len(samples) < cls.MIN_SAMPLES:
+            return upper_bound, None
+        p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+        expected = p99 if stream else p99 * max_tokens
+        timeout = int(expected * cls.P99_FACTOR) + 1
+        return max(cls.MIN_READ_TIMEOUT, min(upper_bound, timeout)), expected
+
+
+class ZaKoCircuitOpenError(Exception):
+    """所有可用接口都处于熔断状态"""
+
+
+class ZaKoCircuitBreaker:
+    """按接口+模型的熔断器：滑动窗口内失败率超过阈值即熔断，冷却后放行一个试探请求（半开）"""
+
+    WINDOW_SIZE = 20
+    MIN_CALLS = 5
+    FAILURE_RATE_THRESHOLD = 0.5
+    OPEN_SECONDS = 30.0
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    _registry: Dict[Tuple[str, str], "ZaKoCircuitBreaker"] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, label: str):
+        self.label = label
+        self.state = self.CLOSED
+        self._outcomes: "deque[bool]" = deque(maxlen=self.WINDOW_SIZE)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_endpoint(cls, endpoint: "ZaKoEndpoint") -> "ZaKoCircuitBreaker":
+        key = (endpoint.url, endpoint.model)
+        with cls._registry_lock:
+            breaker = cls._registry.get(key)
+            if breaker is None:
+                breaker = cls._registry[key] = cls(endpoint.label)
+            return breaker
+
+    def allow(self) -> bool:
+        """是否放行本次请求；半开状态只放行一个试探请求"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.OPEN_SECONDS:
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                logger.info(f"熔断器[{self.label}]：冷却结束，放行一个试探请求")
+                return True
+            return False
+
+    def cancel_probe(self) -> None:
+        """已放行但未实际发出的请求归还试探名额"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probe_in_flight = False
+
+    def record(self, failed: bool) -> None:
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probe_in_flight = False
+                if failed:
+                    self.state = self.OPEN
+                    self._opened_at = time.monotonic()
+                    logger.warning(f"熔断器[{self.label}]：试探失败，继续熔断{self.OPEN_SECONDS:.0f}秒")
+                else:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                    logger.info(f"熔断器[{self.label}]：试探成功，恢复正常")
+                return
+            if self.state != self.CLOSED:
+                return
+            self._outcomes.append(failed)
+            failure_count = sum(self._outcomes)
+            if len(self._outcomes) >= self.MIN_CALLS and failure_count / len(self._outcomes) >= self.FAILURE_RATE_THRESHOLD:
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                logger.warning(
+                    f"熔断器[{self.label}]：最近{len(self._outcomes)}次请求失败{failure_count}次，"
+                    f"熔断{self.OPEN_SECONDS:.0f}秒，期间直接返回降级结果"
+                )
+
+
+def _compile_keywords(keywords: Tuple[str, ...]) -> "re.Pattern[str]":
+    """关键词列表编译为整词匹配的正则，长词优先"""
+    words = sorted(keywords, key=len, reverse=True)
+    return re.compile(r"(?<!\w)(?:" + "|".join(re.escape(w) for w in words) + r")(?!\w)")
+
+
+class ZaKoTagEngine:
+    """本地规则引擎：按默认融合指令的规则3/4/6做确定性处理，关键词索引在类加载时预编译"""
+
+    # 规则3：属性-标签映射库（与默认融合指令保持一致）
+    CLOTHING_KEYWORDS = (
+        "dress", "skirt", "jeans", "pants", "trousers", "jacket", "coat", "shirt", "blouse", "hoodie",
+        "sweater", "uniform", "swimsuit", "bikini", "underwear", "panties", "bra", "socks", "stockings",
+        "tights", "shoes", "boots", "sneakers", "footwear", "clothing", "apparel", "attire", "gown"
+    )
+    FULL_NUDE_KEYWORDS = ("naked", "nude", "undressed")
+    # 眼睛只按颜色取值判断冲突，eye contact、glowing eyes等动作/状态标签不受影响
+    EYE_COLORS = (
+        "red", "blue", "green", "yellow", "purple", "pink", "orange", "brown", "black", "white", "grey", "gray",
+        "silver", "gold", "golden", "amber", "aqua", "violet", "crimson", "multicolored", "gradient"
+    )
+    FEATURE_KEYWORDS = {
+        "hair": ("hair",),
+        "eyes": tuple(f"{color} eyes" for color in EYE_COLORS) + ("heterochromia", "eye color"),
+        "body": ("body", "slim", "muscular", "chubby"),
+    }
+    # 含这些词的特征标签属于子状态/饰品/表情/构图/动作，不参与特征值冲突判断
+    FEATURE_EXEMPT_WORDS = (
+        "ponytail", "twintails", "braid", "bun", "ornament", "ribbon", "flower", "clip", "band", "bow",
+        "pin", "tie", "between", "over", "closed", "half-closed", "covering", "looking",
+        "full body", "upper body", "lower body", "focus", "writing", "paint", "blush",
+        "floating", "flowing", "wet", "messy", "windblown", "blowing", "adjusting", "touching",
+        "holding", "playing with", "hand in", "hands in", "tucking"
+    )
+    FEMALE_KEYWORDS = ("1girl", "2girls", "multiple girls")
+    MALE_FEATURE_KEYWORDS = ("penis", "testicles", "male pubic hair")
+    INTERACTION_KEYWORDS = (
+        "hugging", "hug", "kissing", "kiss", "holding hands", "sex", "straddling", "cowgirl position",
+        "missionary", "doggystyle", "fellatio", "paizuri", "handjob", "grabbing", "embrace", "carrying"
+    )
+
+    # 规则4：画师/风格标签识别
+    ARTIST_PREFIXES = ("artist:", "by ", "style of ")
+    STYLE_TAGS = (
+        "detailed background", "anime screencap", "anime coloring", "official art", "game cg",
+        "illustration", "watercolor", "sketch", "photorealistic", "realistic", "3d", "pixel art"
+    )
+
+    # 规则6：质量增强库
+    QUALITY_TAGS = (
+        "best quality", "masterpiece", "high resolution", "ultra detailed", "sharp focus", "intricate details"
+    )
+    QUALITY_SUPPLEMENT_COUNT = 4
+
+    # 预编译关键词索引
+    _WEIGHT_RE = re.compile(r"^[\(\[\{]+(.*?)(?::\s*-?\d+(?:\.\d+)?)?[\)\]\}]+$")
+    _CANONICAL_WEIGHT_RE = re.compile(r"^([\(\[\{]+)(.*?):\s*(-?\d+(?:\.\d+)?)\s*([\)\]\}]+)$")
+    _CLOTHING_RE = _compile_keywords(CLOTHING_KEYWORDS)
+    _NUDE_RE = _compile_keywords(FULL_NUDE_KEYWORDS)
+    _EXEMPT_RE = _compile_keywords(FEATURE_EXEMPT_WORDS)
+    _FEMALE_RE = _compile_keywords(FEMALE_KEYWORDS)
+    _MALE_FEATURE_RE = _compile_keywords(MALE_FEATURE_KEYWORDS)
+    _INTERACTION_RE = _compile_keywords(INTERACTION_KEYWORDS)
+    _FEATURE_RES = {category: _compile_keywords(words) for category, words in FEATURE_KEYWORDS.items()}
+
+    @staticmethod
+    def split_tags(text: Optional[str]) -> List[str]:
+        """按顶层逗号/换行拆分标签，括号内的逗号和冒号权重语法原样保留"""
+        tags = []
+        current = []
+        depth = 0
+        escaped = False
+        for ch in text or "":
+            if escaped:
+                current.append(ch)
+                escaped = False
+                continue
+            if ch == "\\":
+                current.append(ch)
+                escaped = True
+                continue
+            if ch in "([{":
+                depth += 1
+            elif ch in ")]}":
+                depth = max(0, depth - 1)
+            elif ch in ",\n" and depth == 0:
+                tag = "".join(current).strip()
+                if tag:
+                    tags.append(tag)
+                current = []
+                continue
+            current.append(ch)
+        tag = "".join(current).strip()
+        if tag:
+            tags.append(tag)
+        return tags
+
+    @classmethod
+    def tag_core(cls, tag: str) -> str:
+        """去掉权重括号和数值后的标签主体，统一小写/空格，用于匹配与去重"""
+        core = tag.strip()
+        match = cls._WEIGHT_RE.match(core)
+        if match:
+            core = match.group(1)
+        core = core.replace("\\(", "(").replace("\\)", ")").replace("_", " ").lower()
+        return " ".join(core.split())
+
+    @classmethod
+    def _feature_category(cls, core: str) -> str:
+        if cls._EXEMPT_RE.search(core):
+            return ""
+        for category, pattern in cls._FEATURE_RES.items():
+            if pattern.search(core):
+                return category
+        return ""
+
+    @classmethod
+    def _is_style_tag(cls, core: str) -> bool:
+        return (
+            core.startswith(cls.ARTIST_PREFIXES)
+            or core in cls.STYLE_TAGS
+            or core in cls.QUALITY_TAGS
+        )
+
+    @classmethod
+    def _dedup(cls, tags: List[str], seen: Optional[set] = None) -> List[str]:
+        seen = set() if seen is None else seen
+        result = []
+        for tag in tags:
+            core = cls.tag_core(tag)
+            if core in seen:
+                continue
+            seen.add(core)
+            result.append(tag)
+        return result
+
+    @classmethod
+    def filter_conflicts(cls, character: str, random_tags: List[str]) -> List[str]:
+        """规则3：以人物提示词为基准删除随机提示词中的冲突标签，并去掉与人物重复的标签"""
+        character_cores = [cls.tag_core(tag) for tag in cls.split_tags(character)]
+        character_has_clothing = any(cls._CLOTHING_RE.search(core) for core in character_cores)
+        character_is_female = any(cls._FEMALE_RE.search(core) for core in character_cores)
+        character_features: Dict[str, set] = {}
+        for core in character_cores:
+            category = cls._feature_category(core)
+            if category and core != category:
+                character_features.setdefault(category, set()).add(core)
+
+        random_cores = [cls.tag_core(tag) for tag in random_tags]
+        has_interaction = any(cls._INTERACTION_RE.search(core) for core in random_cores)
+
+        kept = []
+        for tag, core in zip(random_tags, random_cores):
+            if character_has_clothing and (cls._CLOTHING_RE.search(core) or cls._NUDE_RE.search(core)):
+                continue
+            category = cls._feature_category(core)
+            if category in character_features and core not in character_features[category]:
+                continue
+            if character_is_female and not has_interaction and cls._MALE_FEATURE_RE.search(core):
+                continue
+            kept.append(tag)
+        return cls._dedup(kept, seen=set(character_cores))
+
+    @classmethod
+    def prefilter(cls, character: str, random_prompt: str, artist: str) -> Tuple[str, str]:
+        """预过滤：返回 (冲突过滤后的随机提示词, 去重后的画师串)，供LLM处理更短的输入"""
+        random_tags = cls.filter_conflicts(character, cls.split_tags(random_prompt))
+        artist_tags = cls._dedup(cls.split_tags(artist))
+        return ", ".join(random_tags), ", ".join(artist_tags)
+
+    @classmethod
+    def canonical_tag(cls, tag: str) -> str:
+        """标签的规范写法：统一大小写、空格、下划线和权重数值（1.20 -> 1.2），括号形式保留"""
+        text = " ".join(tag.replace("_", " ").lower().split())
+        match = cls._CANONICAL_WEIGHT_RE.match(text)
+        if match:
+            opening, inner, weight, closing = match.groups()
+            return f"{opening}{inner.strip()}:{float(weight):g}{closing}"
+        return text
+
+    @classmethod
+    def canonical_tag_set(cls, text: Optional[str]) -> List[str]:
+        """与顺序无关的标签集合，用作缓存和请求合并的键"""
+        return sorted({cls.canonical_tag(tag) for tag in cls.split_tags(text)})
+
+    @classmethod
+    def reorder_like(cls, output: str, reference: str, locked: str = "") -> str:
+        """按参考输入中的标签顺序重排输出里对应的标签，其他标签位置不变；locked行（人物提示词）原样保留"""
+        order: Dict[str, int] = {}
+        for i, tag in enumerate(cls.split_tags(reference)):
+            order.setdefault(cls.tag_core(tag), i)
+        locked = locked.strip().rstrip(",").strip()
+        lines = []
+        for line in output.split("\n"):
+            content = line.strip().rstrip(",").strip()
+            if not content or content == locked:
+                lines.append(line)
+                continue
+            tags = cls.split_tags(content)
+            slots = [i for i, tag in enumerate(tags) if cls.tag_core(tag) in order]
+            ordered = sorted((tags[i] for i in slots), key=lambda tag: order[cls.tag_core(tag)])
+            for i, tag in zip(slots, ordered):
+                tags[i] = tag
+            lines.append(", ".join(tags) + ("," if line.rstrip().endswith(",") else ""))
+        return "\n".join(lines)
+
+    @classmethod
+    def merge(cls, character: str, random_prompt: str, artist: str, extras: Optional[List[str]] = None) -> str:
+        """完全本地融合：按规则7的结构输出，多角色结构（规则5）保持人物提示词原样"""
+        character = (character or "").strip()
+        scene_tags = cls.filter_conflicts(character, cls.split_tags(random_prompt))
+        for extra in extras or []:
+            scene_tags.extend(cls.filter_conflicts(character, cls.split_tags(extra)))
+
+        # 规则4：画师串 + 随机词中的画师/风格/质量标签合并去重
+        style_tags = list(cls.split_tags(artist))
+        remaining_scene = []
+        for tag in scene_tags:
+            (style_tags if cls._is_style_tag(cls.tag_core(tag)) else remaining_scene).append(tag)
+        character_cores = {cls.tag_core(tag) for tag in cls.split_tags(character)}
+        style_tags = cls._dedup(style_tags, seen=set(character_cores))
+        remaining_scene = cls._dedup(remaining_scene, seen=character_cores | {cls.tag_core(t) for t in style_tags})
+
+        # 规则6：补充尚未出现的通用质量标签
+        if not (character or style_tags or remaining_scene):
+            # 没有任何输入标签时不凭空补充质量标签，交给调用方报错
+            return ""
+        present = character_cores | {cls.tag_core(tag) for tag in style_tags + remaining_scene}
+        quality_tags = [tag for tag in cls.QUALITY_TAGS if tag not in present][:cls.QUALITY_SUPPLEMENT_COUNT]
+
+        lines = [
+            ", ".join(quality_tags),
+            ", ".join(style_tags),
+            character.rstrip(","),
+            ", ".join(remaining_scene),
+        ]
+        return ",\n".join(line for line in lines if line)
+
+
+class ZaKoOutputValidator:
+    """本地校验LLM输出是否符合规则1/2/7，能机械修复的就地修复，修不好的交给调用方重新请求"""
+
+    _CJK_RE = re.compile(r"[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]")
+    _MARKDOWN_PREFIX_RE = re.compile(r"^\s*(?:#+|[-*•>]|\d+[.、)])\s+")
+    # 说明文字的特征：以冒号/句末标点结尾，或单个"标签"长得像句子
+    SENTENCE_ENDINGS = (":", "：", ".", "。", "!", "！", "?", "？")
+    SENTENCE_MIN_WORDS = 6
+
+    @classmethod
+    def _is_weighted(cls, tag: str) -> bool:
+        return tag[:1] in "([{" and bool(ZaKoTagEngine._WEIGHT_RE.match(tag))
+
+    @classmethod
+    def _is_commentary(cls, line: str, tags: List[str], input_cores: set) -> bool:
+        """与输入没有任何共同标签、且含中文或像一句话的行视为说明文字，不区分语言"""
+        if any(ZaKoTagEngine.tag_core(tag) in input_cores for tag in tags):
+            return False
+        return (
+            bool(cls._CJK_RE.search(line))
+            or line.endswith(cls.SENTENCE_ENDINGS)
+            or any(len(tag.split()) >= cls.SENTENCE_MIN_WORDS for tag in tags)
+        )
+
+    @staticmethod
+    def _unwrap_placeholder(tag: str) -> List[str]:
+        # 整行被方括号包住（规则7模板里的占位写法）时拆开；[tag:0.9]这类权重标签不动
+        if tag.startswith("[") and tag.endswith("]") and "," in tag and not re.search(r":\s*-?\d+(?:\.\d+)?\]$", tag):
+            return ZaKoTagEngine.split_tags(tag[1:-1])
+        return [tag]
+
+    @classmethod
+    def validate_and_repair(
+        cls, output: str, character: str, artist: str, inputs: List[str]
+    ) -> Tuple[str, List[str], List[str]]:
+        """返回 (修复后的输出, 已修复项, 无法本地修复的问题)"""
+        engine = ZaKoTagEngine
+        repairs: List[str] = []
+        character = (character or "").strip().rstrip(",").strip()
+        input_cores = {engine.tag_core(tag) for text in inputs for tag in engine.split_tags(text)}
+
+        # 1. 去掉markdown标记、占位符和解释性文字
+        output = output or ""
+        if "**" in output or "```" in output:
+            repairs.append("去除markdown标记")
+        lines: List[List[str]] = []
+        for raw_line in output.replace("**", "").splitlines():
+            line = raw_line.strip()
+            if not line or line.startswith("```"):
+                continue
+            stripped = cls._MARKDOWN_PREFIX_RE.sub("", line)
+            if stripped != line:
+                repairs.append("去除markdown标记")
+                line = stripped
+            tags = []
+            for tag in engine.split_tags(line):
+                unwrapped = cls._unwrap_placeholder(tag)
+                if unwrapped != [tag]:
+                    repairs.append("去除占位方括号")
+                tags.extend(unwrapped)
+            if cls._is_commentary(line, tags, input_cores):
+                repairs.append("删除说明文字/占位符")
+                continue
+            if tags:
+                lines.append(tags)
+
+        # 多角色（规则5）人物提示词跨多行：逐行比对（忽略行尾逗号和空格写法），匹配的行输出原文、不参与去重
+        locked: Dict[int, str] = {}
+        missing_character_line = False
+        if character and "\n" in character:
+            for raw_line in character.splitlines():
+                text = raw_line.strip().rstrip(",").strip()
+                if not text:
+                    continue
+                cores = [engine.tag_core(tag) for tag in engine.split_tags(text)]
+                match = next(
+                    (tags for tags in lines
+                     if id(tags) not in locked and [engine.tag_core(tag) for tag in tags] == cores),
+                    None
+                )
+                if match is None:
+                    missing_character_line = True
+                else:
+                    locked[id(match)] = text
+
+        # 2. 人物提示词必须原样出现：找重合度最高的一行，把其中的人物标签替换为原文并单独成行，
+        #    同一行的其他标签按原位置拆到前后两行保留；找不到就插在画师风格串之后
+        character_index = -1
+        if character and "\n" not in character:
+            character_tags = engine.split_tags(character)
+            character_cores = {engine.tag_core(tag) for tag in character_tags}
+            best_overlap = 0
+            for i, tags in enumerate(lines):
+                overlap = len(character_cores & {engine.tag_core(tag) for tag in tags})
+                if overlap > best_overlap:
+                    best_overlap, character_index = overlap, i
+            if character_index >= 0 and best_overlap * 2 >= len(character_cores):
+                line_tags = lines[character_index]
+                if ", ".join(line_tags) != ", ".join(character_tags):
+                    repairs.append("还原人物提示词原文")
+                first = next(j for j, tag in enumerate(line_tags) if engine.tag_core(tag) in character_cores)
+                before = [tag for tag in line_tags[:first] if engine.tag_core(tag) not in character_cores]
+                after = [tag for tag in line_tags[first:] if engine.tag_core(tag) not in character_cores]
+                if before or after:
+                    repairs.append("人物提示词单独成行")
+                lines[character_index:character_index + 1] = (
+                    ([before] if before else []) + [character_tags] + ([after] if after else [])
+                )
+                if before:
+                    character_index += 1
+            else:
+                character_index = min(2, len(lines))
+                lines.insert(character_index, character_tags)
+                repairs.append("补回人物提示词")
+
+        # 3. 其余行去重（与人物提示词重复的也删掉）
+        seen = {engine.tag_core(tag) for tag in lines[character_index]} if character_index >= 0 else set()
+        for i, tags in enumerate(lines):
+            if i == character_index or id(tags) in locked:
+                continue
+            kept = engine._dedup(tags, seen)
+            if len(kept) != len(tags):
+                repairs.append("删除重复标签")
+            lines[i] = kept
+        issues: List[str] = []
+        if not any(tags for i, tags in enumerate(lines) if i != character_index and id(tags) not in locked):
+            issues.append("输出缺少人物提示词以外的内容")
+
+        # 4. 画师串中的权重标签必须原样保留
+        for weighted_tag in (tag for tag in engine.split_tags(artist) if cls._is_weighted(tag)):
+            if any(weighted_tag in tags for tags in lines):
+                continue
+            core = engine.tag_core(weighted_tag)
+            replaced = False
+            for tags in lines:
+                for j, tag in enumerate(tags):
+                    if engine.tag_core(tag) == core:
+                        tags[j] = weighted_tag
+                        replaced = True
+            if not replaced:
+                # 放进画师风格串（第2行）；该行恰好是人物提示词时新起一行
+                style_index = 1 if len(lines) > 1 else 0
+                if not lines or style_index == character_index or id(lines[style_index]) in locked:
+                    lines.insert(style_index, [])
+                    if 0 <= style_index <= character_index:
+                        character_index += 1
+                lines[style_index].append(weighted_tag)
+            repairs.append("恢复画师权重标签")
+
+        # 人物提示词行直接用原文，保证空格和标点也一字不差
+        output_lines = [
+            character if i == character_index else locked.get(id(tags)) or ", ".join(tags)
+            for i, tags in enumerate(lines) if tags
+        ]
+        repaired = ",\n".join(output_lines)
+        if missing_character_line or (character_index >= 0 and character not in repaired):
+            issues.append("人物提示词未原样保留")
+        return repaired, list(dict.fromkeys(repairs)), issues
+
+
 class ZaKoPromptMerger:
     API_URL = "https://api.siliconflow.cn/v1/chat/completions"
 
@@ -24,6 +1024,37 @@ class ZaKoPromptMerger:
     DEFAULT_TEMPERATURE = 0.7
     DEFAULT_RETRY_TOTAL = 3
 
+    # 结果缓存参数：默认关闭，开启后相同输入直接复用上次结果
+    DEFAULT_CACHE_TTL = 86400
+    CACHE_MEMORY_SIZE = 256
+    CACHE_DISK_MAX_ENTRIES = 5000
+
+    # 流式输出：单角色时规则7的输出结构为质量/画师/人物/场景4行，收齐即停止接收（后面通常只剩说明文字）；
+    # 输入含多角色格式（规则5）时行数不固定，不按行数停止。输出字符数超过输入的倍数+余量时
+    # 视为模型重复生成停不下来，截断后停止
+    STREAM_MAX_OUTPUT_LINES = 4
+    STREAM_OUTPUT_CHAR_FACTOR = 2
+    STREAM_OUTPUT_CHAR_MARGIN = 400
+    _MULTI_CHARACTER_RE = re.compile(r"(?:char\s*\d+|角色\s*[A-Za-z0-9一二三四五六七八九十]+)\s*[:：]", re.IGNORECASE)
+
+    # 预取：后台线程提前融合后续提示词，待处理任务数有上限
+    PREFETCH_WORKERS = 2
+    PREFETCH_MAX_PENDING = 8
+
+    # 熔断时的降级输出：错误信息 / 按输入顺序直接拼接 / 本地规则融合
+    DEGRADED_OUTPUTS = ["错误信息", "拼接原始输入", "本地规则融合"]
+
+    # 多接口对冲请求的线程池大小
+    HEDGE_WORKERS = 16
+
+    # 自适应最大输出Token：估算输入Token × 系数 + 余量，不低于下限
+    AUTO_TOKEN_FACTOR = 1.5
+    AUTO_TOKEN_MARGIN = 200
+    AUTO_MIN_TOKENS = 256
+
+    # 本地规则模式：关闭 / 预过滤后再调用API / 完全本地融合不调用API
+    LOCAL_MODES = ["关闭", "本地预过滤+API", "仅本地融合"]
+
     # 线程本地Session：串行跑图复用连接，提升速度
     _session_local = threading.local()
 
@@ -31,9 +1062,35 @@ class ZaKoPromptMerger:
     _run_count = 0
     _count_lock = threading.Lock()
 
-    @classmethod
-    def INPUT_TYPES(cls) -> Dict[str, Any]:
-        DEFAULT_PROMPT = """# AI绘画提示词融合专家（ZaKo逻辑强化版）
+    # 进程级共享缓存：首次启用时再创建
+    _cache: Optional[ZaKoResponseCache] = None
+    _cache_lock = threading.Lock()
+
+    # Token用量累计：来自响应的usage字段
+    _usage_totals = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+    _usage_lock = threading.Lock()
+
+    # 进程级预取状态：按工作流上下文区分，上下文变化时取消未开始的任务
+    _prefetch_executor: Optional[ThreadPoolExecutor] = None
+    _prefetch_futures: Dict[int, "Future[str]"] = {}
+    _prefetch_context = ""
+    _prefetch_stats = {"ready": 0, "awaited": 0, "missed": 0}
+    _prefetch_lock = threading.Lock()
+
+    _hedge_executor: Optional[ThreadPoolExecutor] = None
+    _hedge_lock = threading.Lock()
+
+    # 批量融合的常驻线程池：工作线程跨批次复用，线程本地Session中的连接不随批次结束而断开
+    _batch_executor: Optional[ThreadPoolExecutor] = None
+    _batch_lock = threading.Lock()
+
+    # 进行中的请求：相同请求键共用一个Future
+    _inflight: Dict[str, "Future[Tuple[Optional[str], int, str]]"] = {}
+    _inflight_stats = {"leader": 0, "follower": 0}
+    _inflight_lock = threading.Lock()
+
+    # 默认融合规则：作为system消息发送，内容固定便于服务端前缀缓存
+    DEFAULT_PROMPT = """# AI绘画提示词融合专家（ZaKo逻辑强化版）
 
 你是一个精密、严谨的AI绘画提示词处理引擎。你的唯一职责是根据以下**不可违反的、具有明确执行顺序的规则**，对输入内容进行处理与格式化，输出可直接用于AI绘画工具（如Stable Diffusion）的提示词。
 
@@ -118,6 +1175,18 @@ class ZaKoPromptMerger:
 [规则5处理后的角色2描述（如有）],
 [...]"""
 
+    # 精简版内置规则：与完整版逻辑一致，输入Token约为完整版的三分之一
+    COMPACT_PROMPT = """你是AI绘画提示词融合引擎，按顺序执行以下规则，只输出结果：
+1. 【人物提示词】原样保留，不得修改、删减、添加或重新排序。
+2. 带权重语法的标签（如 `(artist:miv4t:1.10)`、`(tag:1.2)`、`[tag:0.9]`）和画师标签保持原样。
+3. 冲突消除（只删随机提示词中明确冲突的标签）：人物含服饰（dress, skirt, pants, shirt, uniform, swimsuit, socks, shoes等）时，删除随机词中的服饰标签及naked/nude/undressed，barefoot等局部裸露可保留；人物已指定的发色/发长/瞳色/体型，删除随机词中同类但值不同的标签，ponytail等发型子状态可保留；1girl与1boy有互动姿势时保留，无互动的孤立异性特征删除。
+4. 合并【画师串】与随机词中的画师（by ...、artist:...、style of ...）及风格/质量标签，去重为一行。
+5. 仅当输入含char1：、角色A：等多角色格式时，每个角色单独成行，否则跳过。
+6. 在开头补充3-5个尚未出现的通用质量标签（best quality, masterpiece, high resolution, ultra detailed, sharp focus, intricate details等）。
+7. 只输出纯文本，每行以逗号结尾，依次为：质量标签、画师风格串、人物提示词、过滤后的场景/动作/氛围标签、各角色描述（如有）。不得包含方括号占位符、解释或额外说明。"""
+
+    @classmethod
+    def INPUT_TYPES(cls) -> Dict[str, Any]:
         return {
             "optional": {
                 # 提示词输入区
@@ -143,7 +1212,7 @@ class ZaKoPromptMerger:
                     "widget": "textbox"
                 }),
                 "提示词融合指令": ("STRING", {
-                    "default": DEFAULT_PROMPT,
+                    "default": cls.DEFAULT_PROMPT,
                     "label": "提示词融合规则指令",
                     "multiline": True,
                     "widget": "textbox"
@@ -171,6 +1240,64 @@ class ZaKoPromptMerger:
                     "min": 0, "max": 10, "step": 1,
                     "label": "同模型失败重试次数"
                 }),
+
+                # 新增的控件一律追加在以上原有控件之后：已保存工作流的widgets_values按位置恢复，不能插在中间
+                "本地规则模式": (cls.LOCAL_MODES, {
+                    "default": "关闭",
+                    "label": "本地规则（冲突消除/去重/质量补充）"
+                }),
+                "精简规则": ("BOOLEAN", {
+                    "default": False,
+                    "label": "使用精简版内置规则（仅在融合指令未修改时生效，减少输入Token）"
+                }),
+                "备用接口列表": ("STRING", {
+                    "default": "",
+                    "label": "备用接口（每行：接口地址 | 模型名称 | 密钥，后两项可省略）",
+                    "placeholder": "http://127.0.0.1:8000/v1 | qwen2.5-7b-instruct",
+                    "multiline": True
+                }),
+                "对冲请求": ("BOOLEAN", {
+                    "default": False,
+                    "label": "慢请求对冲（耗时超过历史p95时向下一个接口并发请求）"
+                }),
+                "熔断降级输出": (cls.DEGRADED_OUTPUTS, {
+                    "default": "错误信息",
+                    "label": "接口熔断时的输出（不等待超时，直接返回）"
+                }),
+                "输出校验": ("BOOLEAN", {
+                    "default": True,
+                    "label": "输出校验（本地修复格式问题，修不好时重新请求一次）"
+                }),
+                "标签归一化": ("BOOLEAN", {
+                    "default": False,
+                    "label": "缓存/合并按标签集合匹配（忽略顺序、大小写、空格，人物提示词仍需完全一致）"
+                }),
+                "合并相同请求": ("BOOLEAN", {
+                    "default": True,
+                    "label": "合并同时进行的相同请求（共用一次API调用的结果）"
+                }),
+                "耗时分段日志": ("BOOLEAN", {
+                    "default": False,
+                    "label": "输出每张图的分段耗时（本地规则/缓存/API调用）"
+                }),
+                "流式输出": ("BOOLEAN", {
+                    "default": False,
+                    "label": "流式输出（读取超时按每个数据块计算，输出完整即停止）"
+                }),
+
+                # 结果缓存（默认关闭）
+                "启用缓存": ("BOOLEAN", {
+                    "default": False,
+                    "label": "启用结果缓存（相同输入直接复用）"
+                }),
+                "缓存有效期秒": ("INT", {
+                    "default": cls.DEFAULT_CACHE_TTL,
+                    "min": 60, "max": 2592000, "step": 60
+                }),
+                "自适应超时与Token": ("BOOLEAN", {
+                    "default": False,
+                    "label": "按输入长度估算最大输出Token、按模型近期p99耗时设置读取超时（两项设置值作为上限）"
+                }),
             }
         }
 
@@ -178,7 +1305,7 @@ class ZaKoPromptMerger:
     RETURN_NAMES = ("融合后提示词",)
     FUNCTION = "merge_prompts"
     CATEGORY = "ZaKo"
-    DESCRIPTION = "ZaKo提示词融合器（纯手动密钥·默认DeepSeek-V3.2·无缓存·跑图专用）"
+    DESCRIPTION = "ZaKo提示词融合器（纯手动密钥·默认DeepSeek-V3.2·可选缓存·跑图专用）"
 
     # ---------- 极简工具函数 ----------
     @staticmethod
@@ -195,29 +1322,89 @@ class ZaKoPromptMerger:
             cls._run_count += 1
             return cls._run_count
 
+    @staticmethod
+    def _split_batch_prompts(values: List[Any]) -> List[str]:
+        texts = [value.strip() for value in values if isinstance(value, str) and value.strip()]
+        if len(texts) != 1:
+            # 上游传入多个元素的列表时，每个元素就是一条完整的提示词（内部可含换行）
+            return texts
+        # 只有一个字符串时：JSON数组优先，解析失败再按行拆分（兼容以[开头的权重标签）
+        text = texts[0]
+        if text.startswith("["):
+            try:
+                parsed = json.loads(text)
+            except ValueError:
+                parsed = None
+            if isinstance(parsed, list):
+                return [str(item).strip() for item in parsed if str(item).strip()]
+        return [line.strip() for line in text.splitlines() if line.strip()]
+
+    @classmethod
+    def _parse_endpoints(cls, text: Optional[str], api_key: str, model_name: str) -> List[ZaKoEndpoint]:
+        """主接口 + 备用接口列表；备用接口省略模型/密钥时沿用主接口的配置"""
+        endpoints = [ZaKoEndpoint(cls.API_URL, model_name, api_key)]
+        for line in (text or "").splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = [part.strip() for part in line.split("|")]
+            url = parts[0].rstrip("/")
+            if not url.endswith("/chat/completions"):
+                url = f"{url}/chat/completions"
+            model = parts[1] if len(parts) > 1 and parts[1] else model_name
+            key = parts[2] if len(parts) > 2 and parts[2] else api_key
+            endpoint = ZaKoEndpoint(url, model, key)
+            if endpoint not in endpoints:
+                endpoints.append(endpoint)
+        return endpoints
+
+    @classmethod
+    def _get_hedge_executor(cls) -> ThreadPoolExecutor:
+        with cls._hedge_lock:
+            if ZaKoPromptMerger._hedge_executor is None:
+                ZaKoPromptMerger._hedge_executor = ThreadPoolExecutor(
+                    max_workers=cls.HEDGE_WORKERS, thread_name_prefix="ZaKoHedge"
+                )
+            return ZaKoPromptMerger._hedge_executor
+
+    @classmethod
+    def _get_cache(cls) -> ZaKoResponseCache:
+        with cls._cache_lock:
+            if cls._cache is None:
+                try:
+                    disk_path = os.path.join(_get_data_dir(), "response_cache.sqlite3")
+                except OSError as e:
+                    logger.warning(f"无法创建缓存目录，仅使用内存缓存：{e}")
+                    disk_path = None
+                cls._cache = ZaKoResponseCache(cls.CACHE_MEMORY_SIZE, disk_path, cls.CACHE_DISK_MAX_ENTRIES)
+            return cls._cache
+
     @classmethod
-    def _get_session(cls, retry_times: int) -> requests.Session:
+    def _get_session(cls, retry_times: int, retry_reads: bool = True) -> requests.Session:
         retry_times = int(cls._clamp_num(retry_times, 0, 10))
+        session_key = (retry_times, retry_reads)
         if not hasattr(cls._session_local, "sessions"):
             cls._session_local.sessions = {}
-        if retry_times in cls._session_local.sessions:
-            return cls._session_local.sessions[retry_times]
+        if session_key in cls._session_local.sessions:
+            return cls._session_local.sessions[session_key]
 
         # 配置Session重试和连接池
         sess = requests.Session()
         retry_config = Retry(
             total=retry_times,
             connect=retry_times,
-            read=retry_times,
+            read=retry_times if retry_reads else 0,
             backoff_factor=0.5,
-            status_forcelist=[429, 500, 502, 503, 504],
+            # 429交给进程级限流器统一退避，这里只重试服务端错误
+            status_forcelist=[500, 502, 503, 504],
+            respect_retry_after_header=False,
             allowed_methods=frozenset(["POST"]),
             raise_on_status=False
         )
         adapter = HTTPAdapter(max_retries=retry_config, pool_connections=20, pool_maxsize=50)
         sess.mount("https://", adapter)
         sess.mount("http://", adapter)
-        cls._session_local.sessions[retry_times] = sess
+        cls._session_local.sessions[session_key] = sess
         return sess
 
     @staticmethod
@@ -234,6 +1421,13 @@ class ZaKoPromptMerger:
         txt = (resp.text or "").strip()
         return txt[:200] if txt else ""
 
+    @classmethod
+    def _estimate_max_tokens(cls, prompt_text: str) -> int:
+        # 英文标签约3个字符一个Token，中日文约1个字符一个Token；输出含补充的画质词，留出余量
+        ascii_chars = sum(1 for char in prompt_text if ord(char) < 128)
+        input_tokens = ascii_chars / 3 + (len(prompt_text) - ascii_chars)
+        return max(cls.AUTO_MIN_TOKENS, int(input_tokens * cls.AUTO_TOKEN_FACTOR) + cls.AUTO_TOKEN_MARGIN)
+
     @staticmethod
     def _parse_api_result(data: Dict[str, Any]) -> str:
         content = (
@@ -243,6 +1437,128 @@ class ZaKoPromptMerger:
         )
         return content.strip() if isinstance(content, str) else ""
 
+    @staticmethod
+    def _parse_usage(data: Dict[str, Any]) -> Dict[str, int]:
+        usage = data.get("usage")
+        if not isinstance(usage, dict):
+            return {}
+        # 前缀缓存命中数：OpenAI格式在prompt_tokens_details中，DeepSeek格式为prompt_cache_hit_tokens
+        details = usage.get("prompt_tokens_details")
+        cached_tokens = details.get("cached_tokens") if isinstance(details, dict) else None
+        if cached_tokens is None:
+            cached_tokens = usage.get("prompt_cache_hit_tokens")
+        return {
+            "prompt_tokens": int(usage.get("prompt_tokens") or 0),
+            "completion_tokens": int(usage.get("completion_tokens") or 0),
+            "cached_tokens": int(cached_tokens or 0),
+        }
+
+    @classmethod
+    def _record_usage(cls, usage: Dict[str, int]) -> None:
+        if not usage:
+            return
+        with cls._usage_lock:
+            for name in cls._usage_totals:
+                cls._usage_totals[name] += usage.get(name, 0)
+            totals = dict(cls._usage_totals)
+        logger.info(
+            f"Token用量：输入{usage.get('prompt_tokens', 0)}（前缀缓存命中{usage.get('cached_tokens', 0)}），"
+            f"输出{usage.get('completion_tokens', 0)}；累计输入{totals['prompt_tokens']}"
+            f"（命中{totals['cached_tokens']}），累计输出{totals['completion_tokens']}"
+        )
+
+    def _read_stream(
+        self,
+        resp: requests.Response,
+        start_time: float,
+        trace: Optional[Dict[str, Any]] = None,
+        max_lines: Optional[int] = None,
+        max_chars: Optional[int] = None
+    ) -> Tuple[Optional[str], int, str]:
+        """逐块解析OpenAI兼容的SSE流，读取超时作用于每个数据块；收齐max_lines个非空行或超过max_chars个字符时提前停止"""
+        chunks = []
+        chunk_count = 0
+        char_count = 0
+        usage: Dict[str, int] = {}
+        first_token_time = None
+        finish_reason = None
+        stop_note = ""
+        # SSE固定为UTF-8；响应头没带charset时requests会按ISO-8859-1解码，中文会变成乱码
+        resp.encoding = "utf-8"
+        try:
+            # chunk_size=1：urllib3会攒满chunk_size才返回，逐字节读取才能及时拿到每个数据块
+            for line in resp.iter_lines(chunk_size=1, decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data_text = line[5:].strip()
+                if data_text == "[DONE]":
+                    break
+                try:
+                    data = json.loads(data_text)
+                except ValueError:
+                    continue
+                if isinstance(data.get("error"), dict):
+                    return None, resp.status_code, str(data["error"].get("message", "")).strip()
+                # 开启include_usage时，最后一个数据块携带usage
+                usage = self._parse_usage(data) or usage
+
+                choice = (data.get("choices") or [{}])[0]
+                finish_reason = choice.get("finish_reason") or finish_reason
+                delta = choice.get("delta") or {}
+                content = delta.get("content")
+                if not isinstance(content, str) or not content:
+                    continue
+                if first_token_time is None:
+                    first_token_time = time.time()
+                chunks.append(content)
+                chunk_count += 1
+                char_count += len(content)
+
+                # 输出远长于输入：模型在重复生成，截到最后一个完整标签后停止读取
+                if max_chars is not None and char_count > max_chars:
+                    text = "".join(chunks)[:max_chars]
+                    cut = max(text.rfind(","), text.rfind("\n"))
+                    chunks = [text[:cut + 1] if cut > 0 else text]
+                    stop_note = f"，输出超过{max_chars}字符疑似重复生成，已截断停止"
+                    break
+                # 已收到max_lines个以换行结束的非空行说明结构已完整，截断后停止读取；空行分隔不计入
+                if max_lines is None or "\n" not in content:
+                    continue
+                text = "".join(chunks)
+                lines = [line for line in text[:text.rfind("\n")].split("\n") if line.strip()]
+                if len(lines) >= max_lines:
+                    chunks = ["\n".join(lines[:max_lines])]
+                    stop_note = "，输出结构完整已提前停止"
+                    break
+        except requests.exceptions.ConnectionError as e:
+            # 流读取中途的超时会被requests包装成ConnectionError，还原为超时
+            if e.args and isinstance(e.args[0], ReadTimeoutError):
+                raise requests.exceptions.ReadTimeout(str(e)) from e
+            raise
+        finally:
+            resp.close()
+
+        self._record_usage(usage)
+        if trace is not None:
+            trace["usage"] = usage
+            trace["finish_reason"] = finish_reason
+            if first_token_time is not None:
+                trace["first_token"] = first_token_time - start_time
+        if first_token_time is not None:
+            total_time = time.time() - start_time
+            generate_time = max(time.time() - first_token_time, 1e-6)
+            token_count = usage.get("completion_tokens") or chunk_count
+            logger.info(
+                f"流式输出：首Token耗时{first_token_time - start_time:.2f}秒，"
+                f"共{token_count}个Token，速度{token_count / generate_time:.1f} token/s，"
+                f"总耗时{total_time:.2f}秒{stop_note}"
+            )
+
+        final_result = "".join(chunks).strip()
+        if not final_result:
+            return None, 200, "API返回了空内容"
+        return final_result, 200, ""
+
     def _call_api(
         self,
         session: requests.Session,
@@ -254,49 +1570,377 @@ class ZaKoPromptMerger:
         connect_timeout: int,
         read_timeout: int,
         seed: int,
-        verify_ssl: bool
+        verify_ssl: bool,
+        stream: bool = False,
+        system_prompt: str = "",
+        throttle_retries: int = 0,
+        api_url: Optional[str] = None,
+        adaptive_timeout: bool = False,
+        max_tokens_cap: int = 0
     ) -> Tuple[Optional[str], int, str]:
         headers = {
             "Content-Type": "application/json; charset=utf-8",
             "Authorization": f"Bearer {api_key}"
         }
+        # 规则放在固定的system消息中，每次变化的只有user消息，便于服务端复用前缀缓存
+        messages = [{"role": "user", "content": final_prompt}]
+        if system_prompt:
+            messages.insert(0, {"role": "system", "content": system_prompt})
         payload = {
             "model": model_name,
-            "messages": [{"role": "user", "content": final_prompt}],
+            "messages": messages,
             "temperature": temperature,
             "max_tokens": max_tokens,
-            "stream": False
+            "stream": stream
         }
+        if stream:
+            payload["stream_options"] = {"include_usage": True}
         if seed >= 0:
             payload["seed"] = seed
 
-        resp = session.post(
-            self.API_URL,
-            json=payload,
-            headers=headers,
-            timeout=(connect_timeout, read_timeout),
-            verify=verify_ssl
-        )
+        endpoint_name = urlparse(api_url or self.API_URL).netloc
+        # 自适应读取超时比设置值短时，超时后以设置值重新请求一次，避免慢但正常的请求被误判
+        fallback_timeout = 0
+        if adaptive_timeout:
+            adapted_timeout, expected = ZaKoTimeoutAdvisor.read_timeout(
+                endpoint_name, model_name, stream, max_tokens, read_timeout
+            )
+            if expected is not None:
+                basis = "首Token" if stream else f"输出{max_tokens}Token"
+                logger.info(f"自适应读取超时{adapted_timeout}秒（模型【{model_name}】按近期p99估算{basis}需{expected:.2f}秒）")
+            if adapted_timeout < read_timeout:
+                fallback_timeout, read_timeout = read_timeout, adapted_timeout
+                # urllib3的读取重试会沿用同样的短超时，这一次不重试读取，超时后直接按设置值重新请求
+                fallback_session, session = session, self._get_session(throttle_retries, retry_reads=False)
+
+        # 同一接口+密钥+模型的所有线程共用限流器；429时由限流器统一暂停后再重试
+        limiter = ZaKoRateLimiter.for_key(api_key, model_name, endpoint_name)
+        attempt = 0
+        while attempt <= throttle_retries:
+            waited = limiter.acquire()
+            if waited >= 1.0:
+                logger.info(f"限流等待{waited:.1f}秒后发送请求，{limiter.stats_text()}")
+            # 单次请求的指标：状态码、错误类型、耗时、urllib3重试次数、Token数
+            trace: Dict[str, Any] = {
+                "model": model_name,
+                "endpoint": endpoint_name,
+                "status": 0,
+                "error": "",
+            }
+            outcome: Tuple[Optional[str], int, str] = (None, 0, "")
+            start_time = time.time()
+            try:
+                resp = session.post(
+                    api_url or self.API_URL,
+                    json=payload,
+                    headers=headers,
+                    timeout=(connect_timeout, read_timeout),
+                    verify=verify_ssl,
+                    stream=stream
+                )
+                trace["status"] = resp.status_code
+                trace["ttfb"] = resp.elapsed.total_seconds()
+                trace["retries"] = len(getattr(resp.raw.retries, "history", None) or ())
+                limiter.observe(resp.status_code, resp.headers)
+
+                if resp.status_code == 429 and attempt < throttle_retries:
+                    resp.close()
+                    attempt += 1
+                    continue
+                if resp.status_code >= 400:
+                    error_detail = self._get_error_detail(resp)
+                    outcome = (None, resp.status_code, error_detail)
+                    return outcome
+
+                if stream:
+                    multi_character = bool(self._MULTI_CHARACTER_RE.search(final_prompt))
+                    max_lines = None if multi_character else self.STREAM_MAX_OUTPUT_LINES
+                    max_chars = len(final_prompt) * self.STREAM_OUTPUT_CHAR_FACTOR + self.STREAM_OUTPUT_CHAR_MARGIN
+                    stream_outcome = self._read_stream(resp, start_time, trace, max_lines, max_chars)
+                    if self._retry_truncated(trace, payload, max_tokens_cap):
+                        continue
+                    outcome = stream_outcome
+                    return outcome
 
-        if resp.status_code >= 400:
-            error_detail = self._get_error_detail(resp)
-            return None, resp.status_code, error_detail
+                try:
+                    result_data = resp.json()
+                except ValueError:
+                    outcome = (None, resp.status_code, "API返回了非JSON格式内容")
+                    return outcome
 
+                trace["usage"] = self._parse_usage(result_data)
+                self._record_usage(trace["usage"])
+                final_result = self._parse_api_result(result_data)
+                trace["finish_reason"] = (result_data.get("choices") or [{}])[0].get("finish_reason")
+                if self._retry_truncated(trace, payload, max_tokens_cap):
+                    continue
+                if not final_result:
+                    outcome = (None, 200, "API返回了空内容")
+                    return outcome
+                outcome = (final_result, 200, "")
+                return outcome
+            except requests.exceptions.Timeout as e:
+                trace["error"] = "timeout"
+                if not (fallback_timeout and self._is_read_timeout(e)):
+                    raise
+            except requests.exceptions.SSLError:
+                trace["error"] = "ssl"
+                raise
+            except requests.exceptions.RequestException as e:
+                if not self._is_read_timeout(e):
+                    trace["error"] = "network"
+                    raise
+                trace["error"] = "timeout"
+                if not fallback_timeout:
+                    raise requests.exceptions.ReadTimeout(str(e)) from e
+            except Exception:
+                trace["error"] = "unknown"
+                raise
+            finally:
+                limiter.release()
+                if not trace["error"] and not outcome[0]:
+                    trace["error"] = "http" if trace["status"] >= 400 else "bad_response"
+                trace["total"] = time.time() - start_time
+                ZaKoMetrics.record_call(trace)
+                if outcome[0]:
+                    ZaKoTimeoutAdvisor.record(trace, stream)
+
+            # 只有自适应读取超时触发才会走到这里：超时值记为样本，再以设置的读取超时重新请求一次
+            ZaKoTimeoutAdvisor.record_timeout(endpoint_name, model_name, stream, read_timeout, payload["max_tokens"])
+            logger.warning(f"自适应读取超时{read_timeout}秒内未收到数据，改用设置的{fallback_timeout}秒重新请求")
+            read_timeout, fallback_timeout = fallback_timeout, 0
+            session = fallback_session
+        return None, 429, "请求被限流"
+
+    @staticmethod
+    def _is_read_timeout(error: Exception) -> bool:
+        """读取超时：urllib3未重试时为ReadTimeout，重试耗尽后被requests包装成ConnectionError"""
+        if isinstance(error, requests.exceptions.ReadTimeout):
+            return True
+        reason = getattr(error.args[0], "reason", error.args[0]) if error.args else None
+        return isinstance(error, requests.exceptions.ConnectionError) and isinstance(reason, ReadTimeoutError)
+
+    @staticmethod
+    def _retry_truncated(trace: Dict[str, Any], payload: Dict[str, Any], max_tokens_cap: int) -> bool:
+        """自动估算的max_tokens不够导致输出被截断时，改用设置的上限重新请求一次"""
+        if trace.get("finish_reason") != "length" or max_tokens_cap <= payload["max_tokens"]:
+            return False
+        logger.warning(f"输出达到自动估算的最大输出Token（{payload['max_tokens']}），以上限{max_tokens_cap}重新请求")
+        payload["max_tokens"] = max_tokens_cap
+        trace["error"] = "truncated"
+        return True
+
+    def _call_endpoint(
+        self, endpoint: ZaKoEndpoint, retry_times: int, call_kwargs: Dict[str, Any]
+    ) -> Tuple[Optional[str], int, str]:
+        breaker = ZaKoCircuitBreaker.for_endpoint(endpoint)
+        start_time = time.monotonic()
         try:
-            result_data = resp.json()
-        except ValueError:
-            return None, resp.status_code, "API返回了非JSON格式内容"
+            result = self._call_api(
+                session=self._get_session(retry_times),
+                api_key=endpoint.api_key,
+                model_name=endpoint.model,
+                api_url=endpoint.url,
+                throttle_retries=retry_times,
+                **call_kwargs
+            )
+        except Exception:
+            ZaKoEndpointRouter.record(endpoint, time.monotonic() - start_time, success=False)
+            breaker.record(failed=True)
+            raise
+        ZaKoEndpointRouter.record(endpoint, time.monotonic() - start_time, success=bool(result[0]))
+        # 服务端错误和密钥失效(401/402/403)计入熔断；400和429属于请求本身或限流，不计入
+        status_code = result[1]
+        breaker.record(failed=not result[0] and (status_code >= 500 or status_code in (401, 402, 403)))
+        return result
 
-        final_result = self._parse_api_result(result_data)
-        if not final_result:
-            return None, 200, "API返回了空内容"
-        return final_result, 200, ""
+    def _call_routed(
+        self, endpoints: List[ZaKoEndpoint], retry_times: int, hedge: bool, call_kwargs: Dict[str, Any]
+    ) -> Tuple[Optional[str], int, str]:
+        """按EWMA耗时选接口；失败时切换下一个接口，开启对冲时慢请求超过p95即并发请求下一个接口，先成功者胜出"""
+        if len(endpoints) == 1:
+            if not ZaKoCircuitBreaker.for_endpoint(endpoints[0]).allow():
+                raise ZaKoCircuitOpenError(endpoints[0].label)
+            return self._call_endpoint(endpoints[0], retry_times, call_kwargs)
+
+        ordered = ZaKoEndpointRouter.rank(endpoints)
+        executor = self._get_hedge_executor()
+        pending: Dict["Future[Tuple[Optional[str], int, str]]", ZaKoEndpoint] = {}
+        next_index = 0
+        last_error: Optional[Tuple[int, str]] = None
+        last_exception: Optional[BaseException] = None
+
+        def launch() -> Optional[ZaKoEndpoint]:
+            # 跳过熔断中的接口；放行判断在真正发请求时才做，避免占用半开试探名额
+            nonlocal next_index
+            while next_index < len(ordered):
+                endpoint = ordered[next_index]
+                next_index += 1
+                if ZaKoCircuitBreaker.for_endpoint(endpoint).allow():
+                    pending[executor.submit(self._call_endpoint, endpoint, retry_times, call_kwargs)] = endpoint
+                    return endpoint
+            return None
+
+        first_endpoint = launch()
+        if first_endpoint is None:
+            raise ZaKoCircuitOpenError("、".join(endpoint.label for endpoint in ordered))
+        hedge_delay = ZaKoEndpointRouter.hedge_delay(first_endpoint) if hedge else None
+        while pending:
+            timeout = hedge_delay if hedge_delay is not None and next_index < len(ordered) else None
+            done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # 每次请求只对冲一次，之后等待任一请求完成
+                triggered_delay, hedge_delay = hedge_delay, None
+                hedge_endpoint = launch()
+                if hedge_endpoint is None:
+                    continue
+                logger.info(
+                    f"接口【{first_endpoint.label}】耗时超过p95（{triggered_delay:.1f}秒），"
+                    f"向【{hedge_endpoint.label}】发起对冲请求"
+                )
+                continue
+
+            for future in done:
+                endpoint = pending.pop(future)
+                try:
+                    result, status_code, error_detail = future.result()
+                except Exception as e:
+                    last_exception = e
+                    logger.warning(f"接口【{endpoint.label}】请求异常：{type(e).__name__}")
+                    continue
+                if result:
+                    # 落后的请求无法中断，取消未开始的部分，其余结果直接丢弃
+                    for loser, loser_endpoint in pending.items():
+                        if loser.cancel():
+                            ZaKoCircuitBreaker.for_endpoint(loser_endpoint).cancel_probe()
+                    if endpoint != endpoints[0]:
+                        logger.info(f"已由备用接口【{endpoint.label}】返回结果")
+                    return result, status_code, error_detail
+                last_error = (status_code, error_detail)
+                logger.warning(f"接口【{endpoint.label}】调用失败：HTTP {status_code} - {error_detail}")
+
+            if not pending and next_index < len(ordered):
+                next_endpoint = launch()
+                if next_endpoint is not None:
+                    logger.info(f"切换至下一个接口【{next_endpoint.label}】")
+
+        if last_error is not None:
+            return None, last_error[0], last_error[1]
+        if last_exception is not None:
+            raise last_exception
+        raise ZaKoCircuitOpenError("、".join(endpoint.label for endpoint in ordered))
+
+    @classmethod
+    def _call_single_flight(
+        cls, flight_key: str, call: Callable[[], Tuple[Optional[str], int, str]]
+    ) -> Tuple[Optional[str], int, str]:
+        """同一时刻只有一个线程真正发请求，其余线程等待它的结果或异常"""
+        with cls._inflight_lock:
+            future = cls._inflight.get(flight_key)
+            is_leader = future is None
+            if is_leader:
+                future = cls._inflight[flight_key] = Future()
+                cls._inflight_stats["leader"] += 1
+            else:
+                cls._inflight_stats["follower"] += 1
+            stats = dict(cls._inflight_stats)
+
+        if not is_leader:
+            logger.info(
+                f"相同请求正在进行，合并等待其结果（累计合并{stats['follower']}次/实际请求{stats['leader']}次）"
+            )
+            return future.result()
+
+        try:
+            result = call()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with cls._inflight_lock:
+                cls._inflight.pop(flight_key, None)
+
+    def _validate_output(
+        self,
+        run_count: int,
+        result: str,
+        kwargs: Dict[str, Any],
+        prompt_items: List[Tuple[str, str]],
+        endpoints: List[ZaKoEndpoint],
+        retry_times: int,
+        hedge: bool,
+        call_kwargs: Dict[str, Any]
+    ) -> str:
+        """本地校验并修复输出；修不好时带上问题说明、降低温度重新请求一次"""
+        character = self._trim(kwargs.get("人物提示词", ""))
+        artist = self._trim(kwargs.get("画师串", ""))
+        inputs = [content for _, content in prompt_items]
+        repaired, repairs, issues = ZaKoOutputValidator.validate_and_repair(result, character, artist, inputs)
+        if repairs:
+            logger.info(f"第{run_count}张图：输出已本地修复（{'、'.join(repairs)}）")
+        if not issues:
+            return repaired
+
+        logger.warning(f"第{run_count}张图：输出校验未通过（{'、'.join(issues)}），按约束重新请求一次")
+        retry_kwargs = dict(
+            call_kwargs,
+            final_prompt=(
+                f"{call_kwargs['final_prompt']}\n\n注意：上一次输出不合格（{'、'.join(issues)}）。"
+                f"只输出规则7格式的纯文本，【人物提示词】必须一字不差地单独成行，"
+                f"不要任何解释、方括号占位符或markdown。"
+            ),
+            temperature=min(call_kwargs["temperature"], 0.3)
+        )
+        try:
+            retry_result, _, _ = self._call_routed(endpoints, retry_times, hedge, retry_kwargs)
+        except (requests.exceptions.RequestException, ZaKoCircuitOpenError) as e:
+            logger.warning(f"第{run_count}张图：重新请求失败-{type(e).__name__}")
+            retry_result = None
+        if retry_result:
+            retry_repaired, _, retry_issues = ZaKoOutputValidator.validate_and_repair(
+                retry_result, character, artist, inputs
+            )
+            if not retry_issues:
+                logger.info(f"第{run_count}张图：重新请求的输出校验通过")
+                return retry_repaired
+
+        logger.warning(f"第{run_count}张图：重新请求后仍未通过校验，返回本地修复后的结果")
+        return repaired or result
 
     def merge_prompts(self, **kwargs: Any) -> Tuple[str]:
+        # 分段计时：开启「耗时分段日志」时在API调用结束后输出
+        spans: List[Tuple[str, float]] = []
+        span_start = time.monotonic()
+
+        def mark(phase: str) -> None:
+            nonlocal span_start
+            now = time.monotonic()
+            spans.append((phase, now - span_start))
+            span_start = now
+
         try:
             current_run_count = self._add_run_count()
             logger.info(f"===== 开始处理第{current_run_count}张图的随机提示词 =====")
 
+            # 仅本地融合：按内置规则直接出结果，无需密钥和网络
+            local_mode = kwargs.get("本地规则模式", "关闭")
+            if local_mode == "仅本地融合":
+                local_result = ZaKoTagEngine.merge(
+                    self._trim(kwargs.get("人物提示词", "")),
+                    self._trim(kwargs.get("随机提示词", "")),
+                    self._trim(kwargs.get("画师串", "")),
+                    [self._trim(kwargs.get(name, "")) for name in ("备用1", "备用2")]
+                )
+                if not local_result:
+                    error_msg = f"❌ 第{current_run_count}张图失败：至少输入1个有效提示词"
+                    logger.error(error_msg)
+                    return (error_msg,)
+                logger.info(f"第{current_run_count}张图：本地规则融合完成，未调用API")
+                return (local_result,)
+
             # 【核心】直接读取手动输入的密钥，无任何复杂逻辑
             api_key = self._trim(kwargs.get("硅基流动密钥", ""))
             if not api_key:
@@ -310,20 +1954,36 @@ class ZaKoPromptMerger:
 
             # 读取其他参数
             model_name = self._trim(kwargs.get("模型名称", "deepseek-ai/DeepSeek-V3.2")) or "deepseek-ai/DeepSeek-V3.2"
-            prompt_rule = self._trim(
-                kwargs.get("提示词融合指令", self.INPUT_TYPES()["optional"]["提示词融合指令"][1]["default"])
-            )
+            prompt_rule = self._trim(kwargs.get("提示词融合指令", self.DEFAULT_PROMPT))
+            if kwargs.get("精简规则", False) and prompt_rule == self.DEFAULT_PROMPT.strip():
+                prompt_rule = self.COMPACT_PROMPT
 
             temperature = float(self._clamp_num(float(kwargs.get("温度", self.DEFAULT_TEMPERATURE)), 0.0, 2.0))
             max_tokens = int(self._clamp_num(int(kwargs.get("最大输出Token", self.DEFAULT_MAX_TOKENS)), 64, 8192))
             connect_timeout = int(self._clamp_num(int(kwargs.get("连接超时秒", self.DEFAULT_CONNECT_TIMEOUT)), 2, 120))
             read_timeout = int(self._clamp_num(int(kwargs.get("读取超时秒", self.DEFAULT_READ_TIMEOUT)), 5, 300))
             retry_times = int(self._clamp_num(int(kwargs.get("失败重试次数", self.DEFAULT_RETRY_TOTAL)), 0, 10))
+            adaptive = bool(kwargs.get("自适应超时与Token", False))
+            stream = bool(kwargs.get("流式输出", False))
+            use_cache = bool(kwargs.get("启用缓存", False))
+            cache_ttl = int(self._clamp_num(int(kwargs.get("缓存有效期秒", self.DEFAULT_CACHE_TTL)), 60, 2592000))
             
             # 隐藏参数固定默认值
             verify_ssl = True  # 强制开启SSL安全校验
             seed = -1  # 不设置随机种子
 
+            # 本地预过滤：缩短发给API的随机提示词和画师串
+            if local_mode == "本地预过滤+API":
+                character = self._trim(kwargs.get("人物提示词", ""))
+                random_prompt = self._trim(kwargs.get("随机提示词", ""))
+                artist = self._trim(kwargs.get("画师串", ""))
+                filtered_random, filtered_artist = ZaKoTagEngine.prefilter(character, random_prompt, artist)
+                logger.info(
+                    f"第{current_run_count}张图：本地预过滤，随机提示词"
+                    f"{len(ZaKoTagEngine.split_tags(random_prompt))}→{len(ZaKoTagEngine.split_tags(filtered_random))}个标签"
+                )
+                kwargs = dict(kwargs, **{"随机提示词": filtered_random, "画师串": filtered_artist})
+
             # 收集提示词
             prompt_order = ["人物提示词", "随机提示词", "画师串", "备用1", "备用2"]
             seen_prompt = set()
@@ -343,32 +2003,116 @@ class ZaKoPromptMerger:
                 logger.error(error_msg)
                 return (error_msg,)
 
-            # 拼接最终发给API的提示词
+            # 拼接最终发给API的提示词：规则走system消息，这里只放待融合内容
             prompt_list_text = "\n".join([f"{i+1}. 【{name}】{content}" for i, (name, content) in enumerate(prompt_items)])
-            final_api_prompt = f"{prompt_rule}\n\n待融合提示词：\n{prompt_list_text}"
+            final_api_prompt = f"待融合提示词：\n{prompt_list_text}"
 
-            # 实时调用API，无缓存
-            session = self._get_session(retry_times)
-            try:
-                result, status_code, error_detail = self._call_api(
-                    session=session,
-                    api_key=api_key,
-                    model_name=model_name,
-                    final_prompt=final_api_prompt,
+            # 自适应：输出长度与输入标签量相当，按输入估算max_tokens，截断时再以设置值为上限重试
+            max_tokens_cap = 0
+            if adaptive:
+                estimated_tokens = self._estimate_max_tokens(final_api_prompt)
+                if estimated_tokens < max_tokens:
+                    logger.info(f"第{current_run_count}张图：自动估算最大输出Token为{estimated_tokens}（上限{max_tokens}）")
+                    max_tokens_cap, max_tokens = max_tokens, estimated_tokens
+
+            mark("参数与本地规则")
+
+            # 标签归一化：除人物提示词外，其余输入按标签集合计算指纹，顺序/大小写/空格不同也视为相同请求
+            canonical_prompt = ""
+            reorder_reference = ""
+            if kwargs.get("标签归一化", False):
+                canonical_prompt = ZaKoResponseCache.make_key(**{
+                    name: content if name == "人物提示词" else ZaKoTagEngine.canonical_tag_set(content)
+                    for name, content in prompt_items
+                })
+                reorder_reference = ", ".join(content for name, content in prompt_items if name != "人物提示词")
+            character_prompt = self._trim(kwargs.get("人物提示词", ""))
+
+            # 缓存查询：键为发给API的完整内容哈希
+            cache = None
+            cache_key = ""
+            if use_cache:
+                cache = self._get_cache()
+                cache_key = cache.make_key(
+                    model=model_name,
+                    system=prompt_rule,
+                    prompt=canonical_prompt or final_api_prompt,
                     temperature=temperature,
-                    max_tokens=max_tokens,
-                    connect_timeout=connect_timeout,
-                    read_timeout=read_timeout,
-                    seed=seed,
-                    verify_ssl=verify_ssl
+                    max_tokens=max_tokens
                 )
+                cached_result, cache_tier = cache.get(cache_key)
+                if cached_result:
+                    if reorder_reference:
+                        cached_result = ZaKoTagEngine.reorder_like(cached_result, reorder_reference, character_prompt)
+                    tier_name = "内存" if cache_tier == "memory" else "磁盘"
+                    logger.info(f"第{current_run_count}张图：命中{tier_name}缓存，跳过API调用（{cache.stats_text()}）")
+                    return (cached_result,)
+
+            mark("缓存查询")
+
+            # 实时调用API
+            endpoints = self._parse_endpoints(kwargs.get("备用接口列表", ""), api_key, model_name)
+            call_kwargs = {
+                "final_prompt": final_api_prompt,
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+                "connect_timeout": connect_timeout,
+                "read_timeout": read_timeout,
+                "seed": seed,
+                "verify_ssl": verify_ssl,
+                "stream": stream,
+                "system_prompt": prompt_rule,
+                "adaptive_timeout": adaptive,
+                "max_tokens_cap": max_tokens_cap,
+            }
+            hedge = bool(kwargs.get("对冲请求", False))
+            try:
+                if kwargs.get("合并相同请求", True):
+                    # 完全相同的请求正在进行时不再重复调用，等待并共用其结果
+                    flight_key = ZaKoResponseCache.make_key(
+                        endpoints=endpoints,
+                        payload=dict(call_kwargs, final_prompt=canonical_prompt or final_api_prompt)
+                    )
+                    result, status_code, error_detail = self._call_single_flight(
+                        flight_key, lambda: self._call_routed(endpoints, retry_times, hedge, call_kwargs)
+                    )
+                else:
+                    result, status_code, error_detail = self._call_routed(endpoints, retry_times, hedge, call_kwargs)
                 if result:
-                    logger.info(f"第{current_run_count}张图：模型【{model_name}】调用成功，已返回融合结果")
+                    if kwargs.get("输出校验", True):
+                        result = self._validate_output(
+                            current_run_count, result, kwargs, prompt_items,
+                            endpoints, retry_times, hedge, call_kwargs
+                        )
+                    if reorder_reference:
+                        # 合并等待拿到的是其他顺序的结果，按本次输入的标签顺序重排
+                        result = ZaKoTagEngine.reorder_like(result, reorder_reference, character_prompt)
+                    if cache is not None:
+                        cache.set(cache_key, result, cache_ttl)
+                        logger.info(f"第{current_run_count}张图：模型【{model_name}】调用成功，已返回融合结果（{cache.stats_text()}）")
+                    else:
+                        logger.info(f"第{current_run_count}张图：模型【{model_name}】调用成功，已返回融合结果")
                     return (result,)
                 else:
                     final_error = f"❌ 第{current_run_count}张图失败：模型【{model_name}】调用失败，HTTP {status_code} - {error_detail}"
                     logger.error(final_error)
                     return (final_error,)
+            except ZaKoCircuitOpenError as e:
+                final_error = f"❌ 第{current_run_count}张图失败：接口【{e}】熔断中，已跳过API调用"
+                degraded_output = kwargs.get("熔断降级输出", "错误信息")
+                if degraded_output == "拼接原始输入":
+                    logger.warning(f"{final_error}，返回原始输入拼接结果")
+                    return (",\n".join(content for _, content in prompt_items),)
+                if degraded_output == "本地规则融合":
+                    logger.warning(f"{final_error}，返回本地规则融合结果")
+                    return (ZaKoTagEngine.merge(
+                        self._trim(kwargs.get("人物提示词", "")),
+                        self._trim(kwargs.get("随机提示词", "")),
+                        self._trim(kwargs.get("画师串", "")),
+                        [self._trim(kwargs.get(name, "")) for name in ("备用1", "备用2")]
+                    ),)
+                logger.error(final_error)
+                return (final_error,)
             except requests.exceptions.Timeout:
                 final_error = f"❌ 第{current_run_count}张图失败：模型【{model_name}】请求超时"
                 logger.error(final_error)
@@ -385,6 +2129,11 @@ class ZaKoPromptMerger:
                 final_error = f"❌ 第{current_run_count}张图失败：模型【{model_name}】未知错误-{str(e)[:120]}"
                 logger.error(final_error, exc_info=True)
                 return (final_error,)
+            finally:
+                if kwargs.get("耗时分段日志", False):
+                    mark("API调用")
+                    span_text = "，".join(f"{phase}{duration:.3f}秒" for phase, duration in spans)
+                    logger.info(f"第{current_run_count}张图耗时分段：{span_text}，总计{sum(d for _, d in spans):.3f}秒")
 
         except Exception as e:
             final_error = f"❌ 第{current_run_count}张图失败：{str(e)}"
@@ -392,8 +2141,296 @@ class ZaKoPromptMerger:
             return (final_error,)
 
 
+class ZaKoBatchPromptMerger(ZaKoPromptMerger):
+    """批量融合：一次接收多条随机提示词，线程池并发调用API，按输入顺序返回"""
+
+    DEFAULT_BATCH_CONCURRENCY = 4
+    MAX_BATCH_CONCURRENCY = 32
+
+    @classmethod
+    def INPUT_TYPES(cls) -> Dict[str, Any]:
+        input_types = super().INPUT_TYPES()
+        input_types["optional"]["并发数"] = ("INT", {
+            "default": cls.DEFAULT_BATCH_CONCURRENCY,
+            "min": 1, "max": cls.MAX_BATCH_CONCURRENCY, "step": 1,
+            "label": "同时请求数"
+        })
+        return input_types
+
+    # 列表输入：随机提示词可接多个上游输出，其余参数取第一个值
+    INPUT_IS_LIST = True
+    OUTPUT_IS_LIST = (True,)
+    RETURN_NAMES = ("融合后提示词列表",)
+    FUNCTION = "merge_prompt_batch"
+    DESCRIPTION = "ZaKo批量提示词融合器（随机提示词支持列表/逐行/JSON数组·并发请求·按输入顺序输出）"
+
+    @classmethod
+    def _get_batch_executor(cls) -> ThreadPoolExecutor:
+        with cls._batch_lock:
+            if ZaKoPromptMerger._batch_executor is None:
+                ZaKoPromptMerger._batch_executor = ThreadPoolExecutor(
+                    max_workers=cls.MAX_BATCH_CONCURRENCY, thread_name_prefix="ZaKoBatch"
+                )
+            return ZaKoPromptMerger._batch_executor
+
+    def merge_prompt_batch(self, **kwargs: Any) -> Tuple[List[str]]:
+        random_values = kwargs.pop("随机提示词", None) or []
+        if not isinstance(random_values, list):
+            random_values = [random_values]
+        shared_kwargs = {
+            name: (value[0] if isinstance(value, list) and value else value)
+            for name, value in kwargs.items()
+        }
+        concurrency = int(self._clamp_num(
+            int(shared_kwargs.pop("并发数", self.DEFAULT_BATCH_CONCURRENCY)), 1, self.MAX_BATCH_CONCURRENCY
+        ))
+
+        batch_prompts = self._split_batch_prompts(random_values)
+        if not batch_prompts:
+            # 没有随机提示词时退化为单次融合
+            return ([self.merge_prompts(**shared_kwargs)[0]],)
+
+        logger.info(f"===== 批量融合开始：共{len(batch_prompts)}条随机提示词，并发{concurrency} =====")
+        start_time = time.time()
+
+        # 每条独立走merge_prompts：单条失败只返回该条的错误信息，不中断整批
+        def merge_single(random_prompt: str) -> str:
+            return self.merge_prompts(**shared_kwargs, **{"随机提示词": random_prompt})[0]
+
+        # 常驻线程池是共享的，本批只提交"并发数"个工作任务，各自按顺序领取下一条，保证并发不超过设定值
+        results = [""] * len(batch_prompts)
+        positions = iter(range(len(batch_prompts)))
+        positions_lock = threading.Lock()
+
+        def worker() -> None:
+            while True:
+                with positions_lock:
+                    position = next(positions, None)
+                if position is None:
+                    return
+                results[position] = merge_single(batch_prompts[position])
+
+        executor = self._get_batch_executor()
+        workers = [executor.submit(worker) for _ in range(min(concurrency, len(batch_prompts)))]
+        for future in workers:
+            future.result()
+
+        failed_count = sum(1 for result in results if result.startswith("❌"))
+        logger.info(
+            f"===== 批量融合完成：成功{len(results) - failed_count}条，失败{failed_count}条，"
+            f"耗时{time.time() - start_time:.1f}秒 ====="
+        )
+        return (results,)
+
+
+class ZaKoPrefetchPromptMerger(ZaKoPromptMerger):
+    """预取融合：按序号从随机提示词列表取当前条，同时在后台提前融合后续几条，GPU出图时API请求并行进行"""
+
+    DEFAULT_PREFETCH_COUNT = 2
+
+    @classmethod
+    def INPUT_TYPES(cls) -> Dict[str, Any]:
+        input_types = super().INPUT_TYPES()
+        optional = input_types["optional"]
+        optional.pop("随机提示词", None)
+        optional["随机提示词列表"] = ("STRING", {"forceInput": True})
+        optional["序号"] = ("INT", {
+            "default": 0,
+            "min": 0, "max": 0xffffffff, "step": 1,
+            "control_after_generate": True,
+            "label": "当前序号（超出列表长度时循环）"
+        })
+        optional["预取数量"] = ("INT", {
+            "default": cls.DEFAULT_PREFETCH_COUNT,
+            "min": 0, "max": cls.PREFETCH_MAX_PENDING, "step": 1,
+            "label": "提前融合后续条数（0为关闭）"
+        })
+        return input_types
+
+    FUNCTION = "merge_with_prefetch"
+    DESCRIPTION = "ZaKo预取提示词融合器（按序号取随机提示词列表·后台提前融合后续条目·隐藏API等待时间）"
+
+    @classmethod
+    def _get_prefetch_executor(cls) -> ThreadPoolExecutor:
+        if ZaKoPromptMerger._prefetch_executor is None:
+            ZaKoPromptMerger._prefetch_executor = ThreadPoolExecutor(
+                max_workers=cls.PREFETCH_WORKERS, thread_name_prefix="ZaKoPrefetch"
+            )
+        return ZaKoPromptMerger._prefetch_executor
+
+    def _merge_item(self, shared_kwargs: Dict[str, Any], random_prompt: str) -> str:
+        return self.merge_prompts(**shared_kwargs, **{"随机提示词": random_prompt})[0]
+
+    def merge_with_prefetch(self, **kwargs: Any) -> Tuple[str]:
+        queue_prompts = self._split_batch_prompts([kwargs.pop("随机提示词列表", "")])
+        index = int(kwargs.pop("序号", 0))
+        prefetch_count = int(self._clamp_num(
+            int(kwargs.pop("预取数量", self.DEFAULT_PREFETCH_COUNT)), 0, self.PREFETCH_MAX_PENDING
+        ))
+        if not queue_prompts:
+            return self.merge_prompts(**kwargs)
+
+        position = index % len(queue_prompts)
+        # 上下文 = 除序号外的全部输入，任何一项变化都视为工作流已变更
+        context = ZaKoResponseCache.make_key(params=kwargs, queue=queue_prompts)
+        window = [(position + offset) % len(queue_prompts) for offset in range(1, prefetch_count + 1)]
+        window = [pos for pos in dict.fromkeys(window) if pos != position]
+
+        with self._prefetch_lock:
+            futures = ZaKoPromptMerger._prefetch_futures
+            if context != ZaKoPromptMerger._prefetch_context:
+                cancelled = sum(1 for future in futures.values() if future.cancel())
+                if futures:
+                    logger.info(f"工作流已变更，丢弃{len(futures)}个预取任务（其中{cancelled}个未开始已取消）")
+                futures.clear()
+                ZaKoPromptMerger._prefetch_context = context
+
+            current_future = futures.pop(position, None)
+            # 不在预取窗口内的旧任务直接取消，保证队列有界
+            for pos in [pos for pos in futures if pos not in window]:
+                futures.pop(pos).cancel()
+            executor = self._get_prefetch_executor()
+            for pos in window:
+                if pos not in futures:
+                    futures[pos] = executor.submit(self._merge_item, kwargs, queue_prompts[pos])
+
+        if current_future is not None and not current_future.cancelled():
+            stat_name = "ready" if current_future.done() else "awaited"
+            result = current_future.result()
+            # 预取失败时同步重试一次，避免把旧的错误结果直接交给出图
+            if result.startswith("❌"):
+                result = self._merge_item(kwargs, queue_prompts[position])
+        else:
+            stat_name = "missed"
+            result = self._merge_item(kwargs, queue_prompts[position])
+
+        with self._prefetch_lock:
+            stats = ZaKoPromptMerger._prefetch_stats
+            stats[stat_name] += 1
+            stats_text = f"预取已就绪{stats['ready']}次/需等待{stats['awaited']}次/未预取{stats['missed']}次"
+        logger.info(f"序号{index}（列表第{position + 1}/{len(queue_prompts)}条）：{stats_text}")
+        return (result,)
+
+
+class ZaKoBulkResultReader:
+    """按序号读取离线批量任务（zako_bulk.py）的输出JSONL，把预先算好的融合结果接回工作流"""
+
+    # 已解析的结果文件：路径 -> (修改时间, 大小, {index: result})，文件变化后重新解析
+    _loaded: Dict[str, Tuple[float, int, Dict[int, str]]] = {}
+    _loaded_lock = threading.Lock()
+
+    @classmethod
+    def INPUT_TYPES(cls) -> Dict[str, Any]:
+        return {
+            "required": {
+                "结果文件": ("STRING", {
+                    "default": "",
+                    "multiline": False,
+                    "label": "批量任务输出JSONL（相对路径按ZaKoPromptMerger数据目录解析）"
+                }),
+                "序号": ("INT", {
+                    "default": 0,
+                    "min": 0, "max": 0xffffffff, "step": 1,
+                    "control_after_generate": True,
+                    "label": "输入文件中的行号（从0开始）"
+                }),
+            }
+        }
+
+    RETURN_TYPES = ("STRING",)
+    RETURN_NAMES = ("融合后提示词",)
+    FUNCTION = "read_result"
+    CATEGORY = "ZaKo"
+    DESCRIPTION = "ZaKo批量结果读取（按序号读取离线批量融合的结果·任务运行中也可读取已完成的行）"
+
+    @staticmethod
+    def _resolve_path(path: str) -> str:
+        path = os.path.expanduser(path.strip().strip('"'))
+        return path if os.path.isabs(path) else os.path.join(_get_data_dir(), path)
+
+    @classmethod
+    def IS_CHANGED(cls, **kwargs: Any) -> str:
+        # 批量任务仍在追加结果时，同一序号也需要重新读取
+        path = cls._resolve_path(kwargs.get("结果文件", ""))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return ""
+        return f"{stat.st_mtime}:{stat.st_size}"
+
+    @classmethod
+    def _load_results(cls, path: str) -> Dict[int, str]:
+        stat = os.stat(path)
+        with cls._loaded_lock:
+            cached = cls._loaded.get(path)
+            if cached and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+                return cached[2]
+        results: Dict[int, str] = {}
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                # 同一行号重跑过时以最后一次成功的结果为准
+                if isinstance(record, dict) and record.get("ok") and isinstance(record.get("index"), int):
+                    results[record["index"]] = str(record.get("result", ""))
+        with cls._loaded_lock:
+            cls._loaded[path] = (stat.st_mtime, stat.st_size, results)
+        return results
+
+    def read_result(self, **kwargs: Any) -> Tuple[str]:
+        index = int(kwargs.get("序号", 0))
+        raw_path = str(kwargs.get("结果文件", "")).strip()
+        if not raw_path:
+            error_msg = "❌ 请填写批量任务输出文件路径"
+            logger.error(error_msg)
+            return (error_msg,)
+        path = self._resolve_path(raw_path)
+        try:
+            results = self._load_results(path)
+        except OSError as e:
+            error_msg = f"❌ 读取批量结果失败：{path}（{e}）"
+            logger.error(error_msg)
+            return (error_msg,)
+
+        if index not in results:
+            error_msg = f"❌ 序号{index}没有成功的融合结果（文件中共{len(results)}条成功结果）"
+            logger.error(error_msg)
+            return (error_msg,)
+        logger.info(f"读取批量结果：序号{index}（共{len(results)}条）")
+        return (results[index],)
+
+
+def _register_metrics_route() -> None:
+    """在ComfyUI服务上注册 /zako/metrics（Prometheus文本格式），脱离ComfyUI运行时跳过"""
+    try:
+        from aiohttp import web
+        from server import PromptServer
+        routes = PromptServer.instance.routes
+    except Exception:
+        return
+
+    @routes.get("/zako/metrics")
+    async def zako_metrics(request: Any) -> Any:
+        return web.Response(text=ZaKoMetrics.prometheus_text(), content_type="text/plain")
+
+
+_register_metrics_route()
+
+
 # ComfyUI节点注册
-NODE_CLASS_MAPPINGS = {"ZaKoPromptMerger": ZaKoPromptMerger}
-NODE_DISPLAY_NAME_MAPPINGS = {"ZaKoPromptMerger": "ZaKo提示词融合器"}
+NODE_CLASS_MAPPINGS = {
+    "ZaKoPromptMerger": ZaKoPromptMerger,
+    "ZaKoBatchPromptMerger": ZaKoBatchPromptMerger,
+    "ZaKoPrefetchPromptMerger": ZaKoPrefetchPromptMerger,
+    "ZaKoBulkResultReader": ZaKoBulkResultReader,
+}
+NODE_DISPLAY_NAME_MAPPINGS = {
+    "ZaKoPromptMerger": "ZaKo提示词融合器",
+    "ZaKoBatchPromptMerger": "ZaKo批量提示词融合器",
+    "ZaKoPrefetchPromptMerger": "ZaKo预取提示词融合器",
+    "ZaKoBulkResultReader": "ZaKo批量结果读取",
+}
 __all__ = ["NODE_CLASS_MAPPINGS", "NODE_DISPLAY_NAME_MAPPINGS"]
 
@@ -0,0 +1,32 @@
+import os
+import sys
+from typing import Iterator
+
+import pytest
+
+# 插件以ComfyUI自定义节点目录的形式发布，测试时直接从仓库根目录导入模块
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ComfyUI_ClipAPI_ZaKo import (  # noqa: E402
+    ZaKoCircuitBreaker,
+    ZaKoEndpointRouter,
+    ZaKoRateLimiter,
+    ZaKoTimeoutAdvisor,
+)
+
+SHARED_REGISTRIES = (
+    ZaKoRateLimiter._registry,
+    ZaKoEndpointRouter._stats,
+    ZaKoCircuitBreaker._registry,
+    ZaKoTimeoutAdvisor._samples,
+)
+
+
+@pytest.fixture(autouse=True)
+def clean_shared_state() -> Iterator[None]:
+    # 限流/路由/熔断/超时样本都是进程级状态，每个用例从干净状态开始
+    for registry in SHARED_REGISTRIES:
+        registry.clear()
+    yield
+    for registry in SHARED_REGISTRIES:
+        registry.clear()
@@ -0,0 +1,13 @@
+from ComfyUI_ClipAPI_ZaKo import ZaKoPromptMerger
+
+
+def test_split_batch_prompts_keeps_list_elements_whole() -> None:
+    split = ZaKoPromptMerger._split_batch_prompts
+    assert split(["1girl, smile,\nsitting, garden", "night, city"]) == ["1girl, smile,\nsitting, garden", "night, city"]
+
+
+def test_split_batch_prompts_splits_single_text() -> None:
+    split = ZaKoPromptMerger._split_batch_prompts
+    assert split(["a\nb"]) == ["a", "b"]
+    assert split(['["x", "y"]']) == ["x", "y"]
+    assert split(["[tag:0.9], smile"]) == ["[tag:0.9], smile"]
@@ -0,0 +1,78 @@
+import json
+from typing import Any, Dict, List
+
+import pytest
+
+import zako_bulk
+from ComfyUI_ClipAPI_ZaKo import ZaKoBulkResultReader
+
+
+def _write_lines(path, lines: List[str]) -> str:
+    path.write_text("".join(lines), encoding="utf-8")
+    return str(path)
+
+
+def _record(index: int, ok: bool = True, result: str = "merged") -> str:
+    record: Dict[str, Any] = {"index": index, "id": None, "ok": ok, "result": result if ok else "", "error": ""}
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+
+def test_load_completed_skips_failed_and_partial_lines(tmp_path) -> None:
+    output = _write_lines(tmp_path / "out.jsonl", [_record(0), _record(1, ok=False), _record(2), '{"index": 3, "ok'])
+    assert zako_bulk.load_completed(output) == {0, 2}
+    assert zako_bulk.load_completed(str(tmp_path / "missing.jsonl")) == set()
+
+
+def test_iter_rows_reads_objects_and_reports_bad_lines(tmp_path) -> None:
+    # 序号与输入文件的行号一致：空行不产出，但照常计数
+    source = _write_lines(tmp_path / "in.jsonl", ['{"随机提示词": "a"}\n', "\n", '{"随机提示词": "b", "id": 7}\n'])
+    assert list(zako_bulk.iter_rows(source)) == [(0, {"随机提示词": "a"}), (2, {"随机提示词": "b", "id": 7})]
+
+    bad = _write_lines(tmp_path / "bad.jsonl", ['{"随机提示词": "a"}\n', "[1, 2]\n"])
+    with pytest.raises(ValueError, match="第2行"):
+        list(zako_bulk.iter_rows(bad))
+
+
+def test_repair_tail_terminates_partial_line(tmp_path) -> None:
+    output = tmp_path / "out.jsonl"
+    _write_lines(output, [_record(0), '{"index": 1'])
+    zako_bulk.repair_tail(str(output))
+    assert output.read_text(encoding="utf-8").endswith('{"index": 1\n')
+    zako_bulk.repair_tail(str(output))
+    assert output.read_text(encoding="utf-8").endswith('{"index": 1\n')
+
+
+def test_reader_returns_last_successful_result(tmp_path) -> None:
+    output = _write_lines(
+        tmp_path / "out.jsonl", [_record(0, result="first"), _record(1, ok=False), _record(0, result="rerun")]
+    )
+    reader = ZaKoBulkResultReader()
+    assert reader.read_result(结果文件=output, 序号=0) == ("rerun",)
+    assert reader.read_result(结果文件=output, 序号=1)[0].startswith("❌")
+    assert reader.read_result(结果文件="", 序号=0)[0].startswith("❌")
+
+
+def test_reader_reloads_when_file_grows(tmp_path) -> None:
+    output = tmp_path / "out.jsonl"
+    _write_lines(output, [_record(0)])
+    reader = ZaKoBulkResultReader()
+    assert reader.read_result(结果文件=str(output), 序号=1)[0].startswith("❌")
+    with open(output, "a", encoding="utf-8") as f:
+        f.write(_record(1, result="later"))
+    assert reader.read_result(结果文件=str(output), 序号=1) == ("later",)
+
+
+def test_main_resumes_from_existing_output(tmp_path, monkeypatch: pytest.MonkeyPatch) -> None:
+    source = _write_lines(tmp_path / "in.jsonl", [
+        json.dumps({"人物提示词": "1girl", "随机提示词": prompt}) + "\n" for prompt in ("smile", "night", "rain")
+    ])
+    output = tmp_path / "out.jsonl"
+    _write_lines(output, [_record(1, result="kept")])
+    argv = ["zako_bulk.py", source, str(output), "--options", '{"本地规则模式": "仅本地融合"}']
+    monkeypatch.setattr("sys.argv", argv)
+
+    assert zako_bulk.main() == 0
+    records = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()]
+    assert sorted(record["index"] for record in records) == [0, 1, 2]
+    assert all(record["ok"] for record in records)
+    assert records[0]["result"] == "kept"
@@ -0,0 +1,28 @@
+from ComfyUI_ClipAPI_ZaKo import ZaKoCircuitBreaker, ZaKoEndpoint
+
+ENDPOINT = ZaKoEndpoint("http://a/v1/chat/completions", "m", "k")
+
+
+def test_circuit_breaker_open_half_open_close() -> None:
+    breaker = ZaKoCircuitBreaker.for_endpoint(ENDPOINT)
+    for _ in range(ZaKoCircuitBreaker.MIN_CALLS):
+        breaker.record(failed=True)
+    assert breaker.state == ZaKoCircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    breaker._opened_at -= ZaKoCircuitBreaker.OPEN_SECONDS
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.cancel_probe()
+    assert breaker.allow()
+    breaker.record(failed=False)
+    assert breaker.state == ZaKoCircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_circuit_breaker_needs_min_calls() -> None:
+    breaker = ZaKoCircuitBreaker.for_endpoint(ENDPOINT)
+    for _ in range(ZaKoCircuitBreaker.MIN_CALLS - 1):
+        breaker.record(failed=True)
+    assert breaker.state == ZaKoCircuitBreaker.CLOSED
+    assert breaker.allow()
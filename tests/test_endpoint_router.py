@@ -0,0 +1,31 @@
+import time
+from typing import Any, Dict
+
+import pytest
+
+from ComfyUI_ClipAPI_ZaKo import ZaKoEndpoint, ZaKoEndpointRouter, ZaKoPromptMerger
+
+PRIMARY = ZaKoEndpoint("http://primary/v1/chat/completions", "m", "k")
+BACKUP = ZaKoEndpoint("http://backup/v1/chat/completions", "m2", "k")
+
+
+def test_rank_prefers_lower_ewma() -> None:
+    ZaKoEndpointRouter.record(PRIMARY, 2.0, success=True)
+    ZaKoEndpointRouter.record(BACKUP, 0.5, success=True)
+    assert ZaKoEndpointRouter.rank([PRIMARY, BACKUP]) == [BACKUP, PRIMARY]
+
+
+def test_hedge_returns_backup_result(monkeypatch: pytest.MonkeyPatch) -> None:
+    for _ in range(ZaKoEndpointRouter.HEDGE_MIN_SAMPLES):
+        ZaKoEndpointRouter.record(PRIMARY, 0.01, success=True)
+    ZaKoEndpointRouter.record(BACKUP, 0.05, success=True)
+
+    def fake_call_endpoint(endpoint: ZaKoEndpoint, retry_times: int, call_kwargs: Dict[str, Any]) -> Any:
+        if endpoint == PRIMARY:
+            time.sleep(0.5)
+            return "primary", 200, ""
+        return "backup", 200, ""
+
+    merger = ZaKoPromptMerger()
+    monkeypatch.setattr(merger, "_call_endpoint", fake_call_endpoint)
+    assert merger._call_routed([PRIMARY, BACKUP], 0, True, {}) == ("backup", 200, "")
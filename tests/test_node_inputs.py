@@ -0,0 +1,12 @@
+from ComfyUI_ClipAPI_ZaKo import ZaKoPromptMerger
+
+# 原版节点的控件顺序；已保存工作流的widgets_values按位置恢复，新增控件只能追加在后面
+BASELINE_INPUTS = [
+    "人物提示词", "随机提示词", "画师串", "备用1", "备用2", "硅基流动密钥", "模型名称", "提示词融合指令",
+    "温度", "最大输出Token", "连接超时秒", "读取超时秒", "失败重试次数",
+]
+
+
+def test_new_widgets_are_appended_after_baseline_inputs() -> None:
+    names = list(ZaKoPromptMerger.INPUT_TYPES()["optional"])
+    assert names[:len(BASELINE_INPUTS)] == BASELINE_INPUTS
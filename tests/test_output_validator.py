@@ -0,0 +1,64 @@
+from ComfyUI_ClipAPI_ZaKo import ZaKoOutputValidator
+
+CHARACTER = "1girl, green hair, white dress"
+ARTIST = "(artist:miv4t:1.10)"
+MULTI_CHARACTER = "2girls, smile,\nchar1: red hair, smile,\nchar2：blue hair, smile"
+
+
+def test_validator_keeps_scene_tags_on_character_line() -> None:
+    output = f"best quality,\n{ARTIST},\n{CHARACTER}, smile, garden, sitting"
+    repaired, repairs, issues = ZaKoOutputValidator.validate_and_repair(
+        output, CHARACTER, ARTIST, [CHARACTER, "smile, garden, sitting"]
+    )
+    assert repaired == f"best quality,\n{ARTIST},\n{CHARACTER},\nsmile, garden, sitting"
+    assert "人物提示词单独成行" in repairs
+    assert issues == []
+
+
+def test_validator_splits_single_line_output() -> None:
+    output = f"best quality, {ARTIST}, {CHARACTER}, smile, garden"
+    repaired, _, issues = ZaKoOutputValidator.validate_and_repair(
+        output, CHARACTER, ARTIST, [CHARACTER, "smile, garden"]
+    )
+    assert repaired == f"best quality, {ARTIST},\n{CHARACTER},\nsmile, garden"
+    assert issues == []
+
+
+def test_validator_restores_weighted_artist_tag() -> None:
+    output = f"best quality,\nartist:miv4t,\n{CHARACTER},\nsmile"
+    repaired, repairs, issues = ZaKoOutputValidator.validate_and_repair(output, CHARACTER, ARTIST, [CHARACTER])
+    assert ARTIST in repaired.split(",\n")
+    assert "恢复画师权重标签" in repairs
+    assert issues == []
+
+
+def test_validator_accepts_multi_line_character() -> None:
+    output = f"best quality,\n{ARTIST},\n2girls,smile,\nchar1: red hair, smile,\nchar2：blue hair, smile,\npark, day"
+    repaired, _, issues = ZaKoOutputValidator.validate_and_repair(
+        output, MULTI_CHARACTER, ARTIST, [MULTI_CHARACTER, "park, day"]
+    )
+    assert repaired.split(",\n") == [
+        "best quality", ARTIST, "2girls, smile", "char1: red hair, smile", "char2：blue hair, smile", "park, day"
+    ]
+    assert issues == []
+
+
+def test_validator_reports_missing_multi_line_character() -> None:
+    output = "best quality,\n2girls, smile,\nchar1: red hair, smile,\npark, day"
+    _, _, issues = ZaKoOutputValidator.validate_and_repair(
+        output, MULTI_CHARACTER, "", [MULTI_CHARACTER, "park, day"]
+    )
+    assert issues == ["人物提示词未原样保留"]
+
+
+def test_validator_drops_english_commentary() -> None:
+    output = (
+        f"Here is the merged prompt:\nbest quality,\n{ARTIST},\n{CHARACTER},\nsmile, garden\n"
+        "I removed the red hair tag because it conflicts with the character."
+    )
+    repaired, repairs, issues = ZaKoOutputValidator.validate_and_repair(
+        output, CHARACTER, ARTIST, [CHARACTER, "smile, garden, red hair"]
+    )
+    assert repaired == f"best quality,\n{ARTIST},\n{CHARACTER},\nsmile, garden"
+    assert "删除说明文字/占位符" in repairs
+    assert issues == []
@@ -0,0 +1,18 @@
+from ComfyUI_ClipAPI_ZaKo import ZaKoRateLimiter
+
+
+def test_rate_limiter_unthrottled_until_first_429() -> None:
+    limiter = ZaKoRateLimiter.for_key("sk-test", "m", "a")
+    for _ in range(20):
+        assert limiter.acquire() < 0.05
+    assert limiter.in_flight == 20
+    limiter.observe(429, {"Retry-After": "0"})
+    assert limiter.rate is not None
+    assert limiter.concurrency_limit == 10
+
+
+def test_rate_limiter_is_shared_per_endpoint_key_and_model() -> None:
+    limiter = ZaKoRateLimiter.for_key("sk-test", "m", "a")
+    assert ZaKoRateLimiter.for_key("sk-test", "m", "a") is limiter
+    assert ZaKoRateLimiter.for_key("sk-test", "m", "b") is not limiter
+    assert ZaKoRateLimiter.for_key("sk-test", "m2", "a") is not limiter
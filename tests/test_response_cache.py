@@ -0,0 +1,73 @@
+import os
+import sqlite3
+import time
+
+import pytest
+
+from ComfyUI_ClipAPI_ZaKo import ZaKoResponseCache
+
+
+@pytest.fixture
+def disk_path(tmp_path) -> str:
+    return str(tmp_path / "cache.sqlite3")
+
+
+def test_make_key_ignores_argument_order() -> None:
+    assert ZaKoResponseCache.make_key(a=1, b="x") == ZaKoResponseCache.make_key(b="x", a=1)
+    assert ZaKoResponseCache.make_key(a=1) != ZaKoResponseCache.make_key(a=2)
+
+
+def test_memory_hit_and_miss() -> None:
+    cache = ZaKoResponseCache(4, None, 10)
+    assert cache.get("k") == (None, "")
+    cache.set("k", "v", ttl=60)
+    assert cache.get("k") == ("v", "memory")
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_memory_lru_evicts_oldest() -> None:
+    cache = ZaKoResponseCache(2, None, 10)
+    cache.set("a", "1", ttl=60)
+    cache.set("b", "2", ttl=60)
+    cache.get("a")
+    cache.set("c", "3", ttl=60)
+    assert cache.get("b") == (None, "")
+    assert cache.get("a") == ("1", "memory")
+
+
+def test_expired_entry_is_miss(disk_path: str) -> None:
+    cache = ZaKoResponseCache(4, disk_path, 10)
+    cache.set("k", "v", ttl=-1)
+    assert cache.get("k") == (None, "")
+
+
+def test_disk_hit_survives_new_instance(disk_path: str) -> None:
+    ZaKoResponseCache(4, disk_path, 10).set("k", "v", ttl=60)
+    cache = ZaKoResponseCache(4, disk_path, 10)
+    assert cache.get("k") == ("v", "disk")
+    # 磁盘命中后回填内存层
+    assert cache.get("k") == ("v", "memory")
+
+
+def test_prune_drops_expired_and_least_recent(disk_path: str) -> None:
+    cache = ZaKoResponseCache(4, disk_path, 2)
+    now = time.time()
+    with cache._connect() as conn:
+        conn.executemany(
+            "INSERT INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            [("old", "1", now + 60, now - 30), ("expired", "2", now - 1, now),
+             ("mid", "3", now + 60, now - 20), ("new", "4", now + 60, now - 10)],
+        )
+        cache._prune(conn, now)
+    with cache._connect() as conn:
+        keys = {row[0] for row in conn.execute("SELECT key FROM cache")}
+    assert keys == {"mid", "new"}
+
+
+def test_connections_are_closed(disk_path: str) -> None:
+    cache = ZaKoResponseCache(4, disk_path, 10)
+    with cache._connect() as conn:
+        pass
+    with pytest.raises(sqlite3.ProgrammingError):
+        conn.execute("SELECT 1")
+    assert os.path.exists(disk_path)
@@ -0,0 +1,59 @@
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from ComfyUI_ClipAPI_ZaKo import ZaKoPromptMerger
+
+
+def _run_concurrently(count: int, target) -> None:
+    threads = [threading.Thread(target=target) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+
+
+def test_identical_calls_share_one_request() -> None:
+    calls = []
+    results: List[Tuple[Optional[str], int, str]] = []
+
+    def call() -> Tuple[Optional[str], int, str]:
+        calls.append(1)
+        time.sleep(0.2)
+        return "merged", 200, ""
+
+    _run_concurrently(5, lambda: results.append(ZaKoPromptMerger._call_single_flight("same", call)))
+    assert len(calls) == 1
+    assert results == [("merged", 200, "")] * 5
+    assert ZaKoPromptMerger._inflight == {}
+
+
+def test_followers_receive_leader_exception() -> None:
+    errors = []
+
+    def call() -> Tuple[Optional[str], int, str]:
+        time.sleep(0.2)
+        raise RuntimeError("boom")
+
+    def worker() -> None:
+        try:
+            ZaKoPromptMerger._call_single_flight("failing", call)
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    _run_concurrently(3, worker)
+    assert errors == ["boom"] * 3
+    assert ZaKoPromptMerger._inflight == {}
+
+
+def test_sequential_calls_are_not_coalesced() -> None:
+    calls = []
+
+    def call() -> Tuple[Optional[str], int, str]:
+        calls.append(1)
+        return "merged", 200, ""
+
+    for _ in range(2):
+        ZaKoPromptMerger._call_single_flight("key", call)
+    assert len(calls) == 2
+    assert "key" not in ZaKoPromptMerger._inflight
@@ -0,0 +1,106 @@
+import io
+import json
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+import pytest
+import requests
+from urllib3.exceptions import ReadTimeoutError
+
+from ComfyUI_ClipAPI_ZaKo import ZaKoPromptMerger
+
+
+class FakeStreamResponse:
+    """模拟requests流式响应：按给定片段逐个产出SSE数据行"""
+
+    status_code = 200
+    headers: Dict[str, str] = {}
+
+    def __init__(self, pieces: List[str], error: Optional[Exception] = None):
+        self.pieces = pieces
+        self.error = error
+        self.closed = False
+
+    def iter_lines(self, chunk_size: int = 1, decode_unicode: bool = True) -> Iterator[str]:
+        for piece in self.pieces:
+            yield "data: " + json.dumps({"choices": [{"delta": {"content": piece}}]})
+            yield ""
+        if self.error is not None:
+            raise self.error
+        yield "data: " + json.dumps({"choices": [{"delta": {}, "finish_reason": "stop"}]})
+        yield "data: [DONE]"
+
+    def close(self) -> None:
+        self.closed = True
+
+
+SINGLE_CHARACTER_OUTPUT = "best quality,\n\n(artist:a),\n\n1girl, green hair,\n\nsmile, garden,\n"
+MULTI_CHARACTER_OUTPUT = (
+    "best quality,\n\n(artist:a),\n\n1girl,\n\nsmile,\n\n"
+    "char1: 1girl, red hair,\n\nchar2: 1boy,\n\nchar3: cat,\n\nchar4: dog,\n"
+)
+
+
+def _stream_pieces(text: str) -> List[str]:
+    return [line + "\n" for line in text.split("\n")]
+
+
+def test_read_stream_reads_to_end_without_line_limit() -> None:
+    result, status, _ = ZaKoPromptMerger()._read_stream(
+        FakeStreamResponse(_stream_pieces(MULTI_CHARACTER_OUTPUT)), time.time(), None, None
+    )
+    assert status == 200
+    assert result.endswith("char4: dog,")
+
+
+def test_read_stream_stops_once_structure_is_complete() -> None:
+    response = FakeStreamResponse(_stream_pieces(SINGLE_CHARACTER_OUTPUT + "\n\n以上为融合结果，如需调整请告诉我。"))
+    result, _, _ = ZaKoPromptMerger()._read_stream(
+        response, time.time(), None, ZaKoPromptMerger.STREAM_MAX_OUTPUT_LINES
+    )
+    assert result == SINGLE_CHARACTER_OUTPUT.replace("\n\n", "\n").strip()
+    assert response.closed
+
+
+def test_read_stream_waits_for_last_line_to_end() -> None:
+    # 第4行还没收到换行时可能还在生成，不能提前截断
+    pieces = ["best quality,\n", "(artist:a),\n", "1girl,\n", "smile, ", "garden"]
+    result, _, _ = ZaKoPromptMerger()._read_stream(FakeStreamResponse(pieces), time.time(), None, 4)
+    assert result.endswith("smile, garden")
+
+
+def test_read_stream_cuts_runaway_output_at_tag_boundary() -> None:
+    pieces = ["best quality, "] + ["smile, "] * 1000
+    response = FakeStreamResponse(pieces)
+    result, _, _ = ZaKoPromptMerger()._read_stream(response, time.time(), None, None, 100)
+    assert len(result) <= 100
+    assert result.endswith("smile,")
+    assert response.closed
+
+
+def test_multi_character_input_disables_early_stop() -> None:
+    assert ZaKoPromptMerger._MULTI_CHARACTER_RE.search("char1：1girl\n角色B: 1boy")
+    assert not ZaKoPromptMerger._MULTI_CHARACTER_RE.search("1girl, character focus")
+
+
+def test_read_stream_mid_stream_timeout_is_read_timeout() -> None:
+    error = requests.exceptions.ConnectionError(ReadTimeoutError(None, None, "Read timed out."))
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        ZaKoPromptMerger()._read_stream(FakeStreamResponse(["best quality,\n"], error), time.time())
+
+
+def test_read_stream_records_finish_reason() -> None:
+    trace: Dict[str, Any] = {}
+    ZaKoPromptMerger()._read_stream(FakeStreamResponse(["1girl"]), time.time(), trace)
+    assert trace["finish_reason"] == "stop"
+
+
+def test_read_stream_decodes_utf8_without_charset() -> None:
+    # text/event-stream不带charset时，requests默认按ISO-8859-1解码
+    body = "data: " + json.dumps({"choices": [{"delta": {"content": "红发，1girl"}}]}, ensure_ascii=False)
+    resp = requests.Response()
+    resp.status_code = 200
+    resp.headers["Content-Type"] = "text/event-stream"
+    resp.raw = io.BytesIO((body + "\n\ndata: [DONE]\n\n").encode("utf-8"))
+    result, status, _ = ZaKoPromptMerger()._read_stream(resp, time.time())
+    assert (result, status) == ("红发，1girl", 200)
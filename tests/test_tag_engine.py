@@ -0,0 +1,28 @@
+from ComfyUI_ClipAPI_ZaKo import ZaKoTagEngine
+
+CHARACTER = "1girl, green hair, white dress"
+ARTIST = "(artist:miv4t:1.10)"
+
+
+def test_split_tags_keeps_weight_syntax() -> None:
+    assert ZaKoTagEngine.split_tags("(a, b:1.2), [c:0.9],\nd") == ["(a, b:1.2)", "[c:0.9]", "d"]
+
+
+def test_filter_conflicts_removes_value_conflicts_only() -> None:
+    random_tags = ZaKoTagEngine.split_tags(
+        "full body, upper_body, floating hair, wet hair, ponytail, closed eyes, "
+        "muscular, red hair, short hair, red eyes, pink skirt, nude, smile"
+    )
+    kept = ZaKoTagEngine.filter_conflicts("1girl, slim, green hair, blue eyes, white dress", random_tags)
+    assert kept == ["full body", "upper_body", "floating hair", "wet hair", "ponytail", "closed eyes", "smile"]
+
+
+def test_merge_returns_empty_without_input_tags() -> None:
+    assert ZaKoTagEngine.merge("", "", "", ["", ""]) == ""
+    assert ZaKoTagEngine.merge(CHARACTER, "smile", ARTIST).split(",\n")[1:] == [ARTIST, CHARACTER, "smile"]
+
+
+def test_filter_conflicts_only_matches_eye_colors() -> None:
+    random_tags = ["eye contact", "glowing eyes", "red eyes", "heterochromia", "light blue eyes", "blue eyes"]
+    kept = ZaKoTagEngine.filter_conflicts("1girl, blue eyes", random_tags)
+    assert kept == ["eye contact", "glowing eyes"]
@@ -0,0 +1,22 @@
+from ComfyUI_ClipAPI_ZaKo import ZaKoTagEngine
+
+
+def test_canonical_tag_normalizes_case_spacing_and_weights() -> None:
+    assert ZaKoTagEngine.canonical_tag("Long_Hair") == "long hair"
+    assert ZaKoTagEngine.canonical_tag("(Smile : 1.20)") == "(smile:1.2)"
+    assert ZaKoTagEngine.canonical_tag("[tag:0.90]") == "[tag:0.9]"
+    # 括号形式不同代表权重不同，保留区分
+    assert ZaKoTagEngine.canonical_tag("((smile))") != ZaKoTagEngine.canonical_tag("smile")
+
+
+def test_canonical_tag_set_ignores_order_and_duplicates() -> None:
+    assert ZaKoTagEngine.canonical_tag_set("smile, Long_Hair,\nsmile") == ZaKoTagEngine.canonical_tag_set(
+        "long hair,  smile"
+    )
+    assert ZaKoTagEngine.canonical_tag_set("(smile:1.2)") != ZaKoTagEngine.canonical_tag_set("(smile:1.3)")
+
+
+def test_reorder_like_follows_reference_and_keeps_locked_line() -> None:
+    output = "best quality,\n1girl, b, a,\nnight, smile, garden,"
+    reordered = ZaKoTagEngine.reorder_like(output, "garden, smile, night", locked="1girl, b, a")
+    assert reordered == "best quality,\n1girl, b, a,\ngarden, smile, night,"
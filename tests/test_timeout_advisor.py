@@ -0,0 +1,83 @@
+import datetime
+import json
+import types
+from typing import Any, List
+
+import requests
+from urllib3.exceptions import MaxRetryError, ReadTimeoutError
+
+from ComfyUI_ClipAPI_ZaKo import ZaKoPromptMerger, ZaKoTimeoutAdvisor
+
+ENDPOINT = "api.siliconflow.cn"
+MODEL = "m"
+
+
+def _trace(**fields: Any) -> dict:
+    return dict({"endpoint": ENDPOINT, "model": MODEL, "error": ""}, **fields)
+
+
+def test_non_stream_samples_are_normalized_by_output_tokens() -> None:
+    for _ in range(ZaKoTimeoutAdvisor.MIN_SAMPLES):
+        ZaKoTimeoutAdvisor.record(_trace(total=2.0, usage={"completion_tokens": 100}), stream=False)
+    assert ZaKoTimeoutAdvisor.read_timeout(ENDPOINT, MODEL, False, 1000, 300) == (41, 20.0)
+    assert ZaKoTimeoutAdvisor.read_timeout(ENDPOINT, MODEL, True, 1000, 300) == (300, None)
+
+
+def test_stream_samples_use_first_token_and_skip_retried_calls() -> None:
+    for _ in range(ZaKoTimeoutAdvisor.MIN_SAMPLES):
+        ZaKoTimeoutAdvisor.record(_trace(first_token=4.0, total=9.0), stream=True)
+    ZaKoTimeoutAdvisor.record(_trace(first_token=100.0, retries=1), stream=True)
+    assert ZaKoTimeoutAdvisor.read_timeout(ENDPOINT, MODEL, True, 1000, 300) == (9, 4.0)
+
+
+def test_timeout_samples_raise_p99() -> None:
+    for _ in range(ZaKoTimeoutAdvisor.MIN_SAMPLES):
+        ZaKoTimeoutAdvisor.record(_trace(first_token=1.0), stream=True)
+    assert ZaKoTimeoutAdvisor.read_timeout(ENDPOINT, MODEL, True, 256, 60)[0] == ZaKoTimeoutAdvisor.MIN_READ_TIMEOUT
+    ZaKoTimeoutAdvisor.record_timeout(ENDPOINT, MODEL, True, 5, 256)
+    assert ZaKoTimeoutAdvisor.read_timeout(ENDPOINT, MODEL, True, 256, 60)[0] == 11
+
+
+def test_is_read_timeout_unwraps_urllib3_retries() -> None:
+    wrapped = requests.exceptions.ConnectionError(MaxRetryError(None, "/", ReadTimeoutError(None, "/", "timed out")))
+    assert ZaKoPromptMerger._is_read_timeout(wrapped)
+    assert ZaKoPromptMerger._is_read_timeout(requests.exceptions.ReadTimeout())
+    assert not ZaKoPromptMerger._is_read_timeout(requests.exceptions.ConnectionError("refused"))
+    assert not ZaKoPromptMerger._is_read_timeout(requests.exceptions.ConnectTimeout())
+
+
+class FakeSession:
+    """第一次请求读取超时，之后正常返回，记录每次请求的读取超时"""
+
+    def __init__(self) -> None:
+        self.read_timeouts: List[float] = []
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        self.read_timeouts.append(kwargs["timeout"][1])
+        if len(self.read_timeouts) == 1:
+            raise requests.exceptions.ReadTimeout("timed out")
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.elapsed = datetime.timedelta(seconds=0.1)
+        resp.raw = types.SimpleNamespace(retries=None)
+        resp._content = json.dumps({
+            "choices": [{"message": {"content": "best quality"}, "finish_reason": "stop"}],
+            "usage": {"completion_tokens": 10},
+        }).encode("utf-8")
+        return resp
+
+
+def test_adaptive_timeout_falls_back_to_configured_timeout(monkeypatch) -> None:
+    for _ in range(ZaKoTimeoutAdvisor.MIN_SAMPLES):
+        ZaKoTimeoutAdvisor.record(_trace(total=0.05, usage={"completion_tokens": 10}), stream=False)
+    session = FakeSession()
+    merger = ZaKoPromptMerger()
+    monkeypatch.setattr(merger, "_get_session", lambda retry_times, retry_reads=True: session)
+    result = merger._call_api(
+        session=session, api_key="sk-x", model_name=MODEL, final_prompt="1girl", temperature=0.7,
+        max_tokens=256, connect_timeout=5, read_timeout=60, seed=-1, verify_ssl=True, adaptive_timeout=True,
+    )
+    assert result == ("best quality", 200, "")
+    assert session.read_timeouts == [ZaKoTimeoutAdvisor.MIN_READ_TIMEOUT, 60]
+    # 超时值按每Token耗时记为样本
+    assert len(ZaKoTimeoutAdvisor._samples[(ENDPOINT, MODEL, False)]) == ZaKoTimeoutAdvisor.MIN_SAMPLES + 2
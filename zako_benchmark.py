@@ -0,0 +1,255 @@
+"""ZaKo提示词融合器离线压测：本地模拟 /v1/chat/completions，不消耗真实API额度
+
+用法（在插件目录下运行）：
+    python zako_benchmark.py --requests 200 --concurrency 1,4,16 --latency-ms 800 --rate-429 0.05
+    python zako_benchmark.py --mode batch --stream --stall-rate 0.02 --read-timeout 5
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Tuple
+
+from ComfyUI_ClipAPI_ZaKo import (
+    ZaKoBatchPromptMerger,
+    ZaKoCircuitBreaker,
+    ZaKoEndpointRouter,
+    ZaKoPromptMerger,
+    ZaKoRateLimiter,
+    ZaKoTimeoutAdvisor,
+    logger,
+)
+
+MOCK_RESULT_LINES = [
+    "best quality, masterpiece, ultra detailed",
+    "(artist:miv4t:1.10), detailed background",
+    "1girl, green hair, blue eyes, white dress",
+    "sitting, smile, garden, sunlight",
+]
+
+
+class MockServerConfig:
+    """模拟服务的行为参数：耗时分布、错误注入、卡顿"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.latency = args.latency_ms / 1000.0
+        self.jitter = args.jitter
+        self.rate_429 = args.rate_429
+        self.rate_5xx = args.rate_5xx
+        self.stall_rate = args.stall_rate
+        self.stall_seconds = args.stall_seconds
+        self.retry_after = args.retry_after
+        self.received = 0
+        self.lock = threading.Lock()
+
+    def sample_latency(self) -> float:
+        # 对数正态分布：中位数为latency，jitter越大长尾越明显
+        return self.latency * random.lognormvariate(0.0, self.jitter) if self.jitter > 0 else self.latency
+
+
+class MockChatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config: MockServerConfig
+
+    def log_message(self, *args: Any) -> None:
+        pass
+
+    def _send_json(self, status: int, data: Dict[str, Any], headers: Dict[str, str] = None) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self) -> None:
+        config = self.config
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        with config.lock:
+            config.received += 1
+
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        roll = random.random()
+        if roll < config.rate_429:
+            self._send_json(429, {"error": {"message": "rate limited"}}, {"Retry-After": str(config.retry_after)})
+            return
+        if roll < config.rate_429 + config.rate_5xx:
+            self._send_json(503, {"error": {"message": "service unavailable"}})
+            return
+
+        stalled = random.random() < config.stall_rate
+        time.sleep(config.sample_latency())
+        usage = {"prompt_tokens": 900, "completion_tokens": 60}
+        try:
+            if payload.get("stream"):
+                self._stream(stalled, usage)
+                return
+            if stalled:
+                # 先发响应头再卡住，模拟生成停滞
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", "100")
+                self.end_headers()
+                self.wfile.flush()
+                time.sleep(config.stall_seconds)
+                return
+            self._send_json(200, {
+                "choices": [{"message": {"role": "assistant", "content": ",\n".join(MOCK_RESULT_LINES)}}],
+                "usage": usage,
+            })
+        except OSError:
+            # 客户端超时断开
+            pass
+
+    def _stream(self, stalled: bool, usage: Dict[str, int]) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        chunks = [f"{line},\n" for line in MOCK_RESULT_LINES]
+        for i, chunk in enumerate(chunks):
+            if stalled and i == len(chunks) // 2:
+                time.sleep(self.config.stall_seconds)
+            data = {"choices": [{"delta": {"content": chunk}}]}
+            self.wfile.write(f"data: {json.dumps(data)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(0.01)
+        self.wfile.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+
+def start_mock_server(config: MockServerConfig) -> Tuple[ThreadingHTTPServer, str]:
+    handler = type("BoundMockChatHandler", (MockChatHandler,), {"config": config})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def run_level(args: argparse.Namespace, config: MockServerConfig, concurrency: int) -> Dict[str, Any]:
+    # 每个并发档位从干净的限流/路由/熔断/超时统计开始，避免上一档的状态影响结果
+    ZaKoRateLimiter._registry.clear()
+    ZaKoEndpointRouter._stats.clear()
+    ZaKoCircuitBreaker._registry.clear()
+    ZaKoTimeoutAdvisor._samples.clear()
+    with config.lock:
+        config.received = 0
+
+    node_kwargs = {
+        "硅基流动密钥": "sk-benchmark",
+        "人物提示词": "1girl, green hair, blue eyes, white dress",
+        "画师串": "(artist:miv4t:1.10)",
+        "读取超时秒": args.read_timeout,
+        "连接超时秒": 2,
+        "失败重试次数": args.retries,
+        "流式输出": args.stream,
+    }
+    random_prompts = [f"smile, garden, sitting, variant {i}" for i in range(args.requests)]
+    latencies: List[float] = []
+    results: List[str] = []
+    start = time.monotonic()
+
+    if args.mode == "batch":
+        batch_kwargs = {name: [value] for name, value in node_kwargs.items()}
+        batch_kwargs["随机提示词"] = random_prompts
+        batch_kwargs["并发数"] = [concurrency]
+        batch_merger = ZaKoBatchPromptMerger()
+        merge_item = batch_merger.merge_prompts
+
+        # 批量节点内部逐条调用merge_prompts，在实例上包一层记录每条的耗时
+        def timed_merge(**item_kwargs: Any) -> Tuple[str]:
+            item_start = time.monotonic()
+            try:
+                return merge_item(**item_kwargs)
+            finally:
+                latencies.append(time.monotonic() - item_start)
+
+        batch_merger.merge_prompts = timed_merge
+        results = batch_merger.merge_prompt_batch(**batch_kwargs)[0]
+    else:
+        merger = ZaKoPromptMerger()
+
+        def merge_single(random_prompt: str) -> str:
+            item_start = time.monotonic()
+            result = merger.merge_prompts(**node_kwargs, **{"随机提示词": random_prompt})[0]
+            latencies.append(time.monotonic() - item_start)
+            return result
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(merge_single, random_prompts))
+
+    elapsed = time.monotonic() - start
+    failed = sum(1 for result in results if result.startswith("❌"))
+    return {
+        "concurrency": concurrency,
+        "elapsed": elapsed,
+        "throughput": len(results) / elapsed if elapsed > 0 else 0.0,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "failed": failed,
+        "amplification": config.received / max(1, len(results)),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="ZaKo提示词融合器离线压测（本地模拟服务）")
+    parser.add_argument("--requests", type=int, default=100, help="每个并发档位的请求数")
+    parser.add_argument("--concurrency", default="1,4,8", help="并发档位，逗号分隔")
+    parser.add_argument("--mode", choices=["single", "batch"], default="single",
+                        help="single：逐条调用merge_prompts；batch：走批量融合节点")
+    parser.add_argument("--stream", action="store_true", help="使用流式输出")
+    parser.add_argument("--latency-ms", type=float, default=500.0, help="模拟服务耗时中位数（毫秒）")
+    parser.add_argument("--jitter", type=float, default=0.5, help="耗时对数正态分布的sigma，0为固定耗时")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="返回429的概率")
+    parser.add_argument("--rate-5xx", type=float, default=0.0, help="返回503的概率")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429响应的Retry-After秒数")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="响应体卡住的概率")
+    parser.add_argument("--stall-seconds", type=float, default=30.0, help="卡住的秒数")
+    parser.add_argument("--read-timeout", type=int, default=10, help="节点的读取超时秒")
+    parser.add_argument("--retries", type=int, default=3, help="节点的失败重试次数")
+    parser.add_argument("--verbose", action="store_true", help="输出节点的INFO日志")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+
+    config = MockServerConfig(args)
+    server, url = start_mock_server(config)
+    ZaKoPromptMerger.API_URL = url
+    print(f"模拟服务：{url}，模式：{args.mode}{'（流式）' if args.stream else ''}，每档{args.requests}条请求")
+
+    header = f"{'并发':>4} {'耗时s':>8} {'吞吐/s':>8} {'p50s':>7} {'p95s':>7} {'p99s':>7} {'失败':>5} {'请求放大':>8}"
+    print(header)
+    try:
+        for concurrency in [int(c) for c in args.concurrency.split(",") if c.strip()]:
+            row = run_level(args, config, max(1, concurrency))
+            print(
+                f"{row['concurrency']:>4} {row['elapsed']:>8.2f} {row['throughput']:>8.2f} "
+                f"{row['p50']:>7.2f} {row['p95']:>7.2f} {row['p99']:>7.2f} "
+                f"{row['failed']:>5} {row['amplification']:>8.2f}"
+            )
+    finally:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
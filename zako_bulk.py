@@ -0,0 +1,154 @@
+"""ZaKo提示词融合器离线批量任务：JSONL输入、JSONL输出，可断点续跑
+
+输入每行一个JSON对象，键与节点输入同名（人物提示词/随机提示词/画师串/备用1/备用2），可带 id 字段；
+也可以带其他节点参数（如 温度、本地规则模式）覆盖命令行的统一设置。
+输出每行记录 index/id/ok/result，逐行写入并落盘；重新运行同一命令会跳过已成功的行，只处理剩余和失败的行。
+结果可用「ZaKo批量结果读取」节点按序号读回工作流。
+
+用法（在插件目录下运行）：
+    python zako_bulk.py prompts.jsonl results.jsonl --api-key sk-xxx --concurrency 8
+    python zako_bulk.py prompts.jsonl results.jsonl --options '{"本地规则模式": "本地预过滤+API", "启用缓存": true}'
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterator, Set, Tuple
+
+from ComfyUI_ClipAPI_ZaKo import ZaKoPromptMerger, logger
+
+
+def load_completed(output_path: str) -> Set[int]:
+    """从已有输出中找出成功的行号；崩溃时写了一半的最后一行直接忽略"""
+    completed: Set[int] = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict) and record.get("ok") and isinstance(record.get("index"), int):
+                completed.add(record["index"])
+    return completed
+
+
+def iter_rows(input_path: str) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """逐行读取输入，不一次性载入内存；index为输入文件中的行号（从0开始），空行跳过但照常计数"""
+    with open(input_path, "r", encoding="utf-8") as f:
+        for index, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                raise ValueError(f"第{index + 1}行不是合法JSON：{e}") from e
+            if not isinstance(row, dict):
+                raise ValueError(f"第{index + 1}行应为JSON对象")
+            yield index, row
+
+
+def repair_tail(output_path: str) -> None:
+    # 上次崩溃可能留下没有换行的半行，补一个换行，避免新记录接在半行后面
+    if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+        return
+    with open(output_path, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="ZaKo提示词融合器离线批量任务（可断点续跑）")
+    parser.add_argument("input", help="输入JSONL路径")
+    parser.add_argument("output", help="输出JSONL路径（同时作为断点记录）")
+    parser.add_argument("--api-key", default=os.environ.get("SILICONFLOW_API_KEY", ""),
+                        help="硅基流动密钥，默认读取环境变量 SILICONFLOW_API_KEY")
+    parser.add_argument("--model", default="deepseek-ai/DeepSeek-V3.2", help="模型名称")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时请求数")
+    parser.add_argument("--options", default="{}", help="统一的节点参数（JSON对象），如温度、本地规则模式")
+    parser.add_argument("--max-consecutive-failures", type=int, default=20,
+                        help="连续失败达到该次数即停止（如密钥失效或被限流），重新运行可从断点继续")
+    parser.add_argument("--verbose", action="store_true", help="输出节点的INFO日志")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+    try:
+        options = json.loads(args.options)
+    except ValueError as e:
+        print(f"--options 不是合法JSON：{e}", file=sys.stderr)
+        return 1
+    if not isinstance(options, dict):
+        print("--options 应为JSON对象", file=sys.stderr)
+        return 1
+
+    completed = load_completed(args.output)
+    if completed:
+        print(f"从断点继续：已完成{len(completed)}行，将跳过")
+    repair_tail(args.output)
+
+    merger = ZaKoPromptMerger()
+    concurrency = max(1, args.concurrency)
+    write_lock = threading.Lock()
+    stats = {"ok": 0, "failed": 0, "consecutive_failures": 0}
+    start_time = time.monotonic()
+
+    def merge_row(index: int, row: Dict[str, Any]) -> Dict[str, Any]:
+        node_kwargs = dict(options, **{"硅基流动密钥": args.api_key, "模型名称": args.model})
+        node_kwargs.update({name: value for name, value in row.items() if name != "id"})
+        result = merger.merge_prompts(**node_kwargs)[0]
+        ok = bool(result) and not result.startswith("❌")
+        return {"index": index, "id": row.get("id"), "ok": ok, "result": result if ok else "", "error": "" if ok else result}
+
+    stopped = False
+    with open(args.output, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        def write_record(record: Dict[str, Any]) -> None:
+            with write_lock:
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                os.fsync(out.fileno())
+                stats["ok" if record["ok"] else "failed"] += 1
+                stats["consecutive_failures"] = 0 if record["ok"] else stats["consecutive_failures"] + 1
+                done = stats["ok"] + stats["failed"]
+                if done % 50 == 0:
+                    rate = done / max(time.monotonic() - start_time, 1e-6)
+                    print(f"已处理{done}行（成功{stats['ok']}，失败{stats['failed']}），{rate:.2f}行/秒")
+
+        pending: Set["Future[Dict[str, Any]]"] = set()
+
+        def drain(limit: int) -> None:
+            # 保持进行中的任务不超过limit，输入文件按需读取
+            while len(pending) > limit:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.discard(future)
+                    write_record(future.result())
+
+        for index, row in iter_rows(args.input):
+            if index in completed:
+                continue
+            if stats["consecutive_failures"] >= args.max_consecutive_failures:
+                stopped = True
+                break
+            pending.add(executor.submit(merge_row, index, row))
+            drain(concurrency * 2)
+        drain(0)
+
+    elapsed = time.monotonic() - start_time
+    print(f"本次处理{stats['ok'] + stats['failed']}行：成功{stats['ok']}，失败{stats['failed']}，耗时{elapsed:.1f}秒")
+    if stopped:
+        print(f"连续失败{stats['consecutive_failures']}次，已停止；排查后重新运行同一命令即可从断点继续", file=sys.stderr)
+        return 2
+    return 0 if stats["failed"] == 0 else 3
+
+
+if __name__ == "__main__":
+    sys.exit(main())